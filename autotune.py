@@ -17,10 +17,11 @@ from gi.repository import Gtk
 import pld
 import twisted.internet.defer
 import time
+import runlog
 
 import matplotlib.figure
 import matplotlib.ticker
-from matplotlib.backends.backend_gtk3cairo import FigureCanvasGTK3Cairo as FigureCanvas
+import chart
 
 class ATWindow(Gtk.Window):
     def __init__(self, pid):
@@ -37,17 +38,15 @@ class ATWindow(Gtk.Window):
         self.out_axes.set_ylabel('OUT (%)')
         self.out_axes.autoscale()
         self.axes.grid()
-        self.pv_x = []
-        self.pv_y = []
-        self.sv_x = []
-        self.sv_y = []
-        self.out_x = []
-        self.out_y = []
-        self.pv_plot, = self.axes.plot(self.pv_x, self.pv_y, 'b--') #b
-        self.sv_plot, = self.axes.plot(self.sv_x, self.sv_y, 'k-') #k
-        self.out_plot, = self.out_axes.plot(self.out_x, self.out_y, 'r:') #r
-
-        self.canvas = FigureCanvas(f)
+        self.pv_plot, = self.axes.plot([], [], 'b--') #b
+        self.sv_plot, = self.axes.plot([], [], 'k-') #k
+        self.out_plot, = self.out_axes.plot([], [], 'r:') #r
+
+        self.chart = chart.StripChart(f, interval=1)
+        self.chart.add('PV', self.pv_plot)
+        self.chart.add('dSV', self.sv_plot)
+        self.chart.add('OUT', self.out_plot)
+        self.canvas = self.chart.canvas
         self.canvas.set_size_request(800,600)
 
         vbox.add(self.canvas)
@@ -71,11 +70,14 @@ class ATWindow(Gtk.Window):
         vbox.add(hbox)
 
         self.add(vbox)
-        self.run = True
         self.start_at = True
         self.stop_at = False
-        self.d = self.loop()
-        self.d.addErrback(lambda x: None)
+        self.log = None
+        self.t0 = time.time()
+        self.flags = None
+        self.sample = {}
+        self.subs = [ pid.subscribe('flags', 1, self.on_flags) ]
+        self.chart.start()
         self.connect('delete-event', self.on_delete)
 
     def on_start(self, widget):
@@ -85,71 +87,63 @@ class ATWindow(Gtk.Window):
         self.stop_at = True
 
     def on_delete(self, widget, event):
-        self.run = False
+        for sub in self.subs:
+            self.pid.unsubscribe(sub)
+        self.subs = []
+        self.chart.stop()
+        if self.log:
+            self.log.close()
+            self.log = None
+        d = self.pid.coil('NAT')
+        d.addErrback(lambda x: None)
 
     def on_close(self, widget):
         self.emit('delete-event', None)
         self.destroy()
 
-    @twisted.internet.defer.inlineCallbacks
-    def loop(self):
-        start = time.time()
-        while self.run:
-            try:
-                d = yield self.pid.flags()
-                active = d['AT']
-                if active:
-                    self.stop.set_sensitive(True)
-                    self.start.set_sensitive(False)
-                    if self.stop_at:
-                        yield self.pid.coil('NAT')
-
-                    pv, mult = yield self.pid.holding_read('PV')
-                    self.pv_x.append(time.time() - start)
-                    self.pv_y.append(pv)
-                    self.pv_plot.set_data(self.pv_x, self.pv_y)
-                    self.axes.relim()
-                    self.axes.autoscale()
-                    self.canvas.draw()
-
-                    sv, mult = yield self.pid.holding_read('dSV')
-                    self.sv_x.append(time.time() - start)
-                    self.sv_y.append(sv)
-                    self.sv_plot.set_data(self.sv_x, self.sv_y)
-                    self.axes.relim()
-                    self.axes.autoscale()
-                    self.canvas.draw()
-
-                    out, mult = yield self.pid.holding_read('OUT')
-                    self.out_x.append(time.time() - start)
-                    self.out_y.append(out)
-                    self.out_plot.set_data(self.out_x, self.out_y)
-                    self.out_axes.relim()
-                    self.out_axes.autoscale()
-                    self.canvas.draw()
-
-                else:
-                    self.start.set_sensitive(True)
-                    self.stop.set_sensitive(False)
-                    if self.start_at:
-                        yield self.pid.raw('ModL', 'SV')
-                        yield self.pid.raw('At', 'On')
-                        start = time.time()
-                        self.pv_x = []
-                        self.pv_y = []
-                        self.sv_x = []
-                        self.sv_y = []
-                        self.out_x = []
-                        self.out_y = []
-
-                self.start_at = False
-                self.stop_at = False
-            except:
-                pass
-
-            d = twisted.internet.defer.Deferred()
-            twisted.internet.reactor.callLater(1, d.callback, None)
-            yield d
-
-        yield self.pid.coil('NAT')
+    def on_flags(self, n, flags, mult):
+        if flags is None or not self.subs:
+            return
+        self.flags = flags
+        if flags['AT']:
+            self.stop.set_sensitive(True)
+            self.start.set_sensitive(False)
+            if self.stop_at:
+                d = self.pid.coil('NAT')
+                d.addErrback(lambda x: None)
+            # Only follow the process while tuning.
+            if len(self.subs) == 1:
+                self.subs += [ self.pid.subscribe(n, 1, self.on_sample)
+                               for n in [ 'PV', 'dSV', 'OUT' ] ]
+        else:
+            self.start.set_sensitive(True)
+            self.stop.set_sensitive(False)
+            for sub in self.subs[1:]:
+                self.pid.unsubscribe(sub)
+            del self.subs[1:]
+            if self.start_at:
+                d = self.start_tune()
+                d.addErrback(lambda x: None)
+
+        self.start_at = False
+        self.stop_at = False
 
+    @twisted.internet.defer.inlineCallbacks
+    def start_tune(self):
+        yield self.pid.raw('ModL', 'SV')
+        yield self.pid.raw('At', 'On')
+        self.t0 = time.time()
+        self.chart.clear()
+        if self.log:
+            self.log.close()
+            self.log = None
+
+    def on_sample(self, n, val, mult):
+        self.chart.append(n, time.time() - self.t0, val)
+        self.sample[n] = val
+        if len(self.sample) == 3:
+            if self.log is None:
+                self.log = runlog.new_run('autotune', self.pid.unit_id)
+            self.log.append(time.time(), self.sample['PV'], self.sample['dSV'],
+                self.sample['OUT'], None, None, runlog.pack_bits(self.flags, pld.bits))
+            self.sample = {}
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright (C) 2012 Russ Dill <Russ.Dill@asu.edu>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+# Protocol benchmarks. Runs the GUI's bus workloads against an emulated
+# controller, or a real one, and reports transaction latency percentiles,
+# throughput and bytes on the wire, saved as JSON for comparing runs.
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+import twisted.internet.defer
+import twisted.internet.reactor
+import pld
+
+# The registers each GUI tab reads when shown.
+tabs = {
+    'control':  [ 'SV', 'AL1', 'AL2', 'At' ],
+    'work':     [ 'AL1y', 'AL1C', 'AL2y', 'AL2C', 'P', 'I', 'd', 'Ct', 'SF', 'Pd',
+                  'bb', 'outL', 'outH', 'nout', 'Psb', 'FILt' ],
+    'function': [ 'Inty', 'PvL', 'PvH', 'dot', 'rd', 'obty', 'obL', 'obH', 'oAty',
+                  'EL', 'SS', 'rES', 'uP', 'ModL', 'PrL', 'PrH', 'corf', 'Id', 'bAud' ],
+    'pid':      [ col + str(row) for row in range(1,10) for col in "PId" ],
+    'ramp_soak': [ col + ('%02d' % row) for row in range(1,65) for col in [ "C-", "t-", "Sv" ] ],
+}
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+class Recorder(object):
+    def __init__(self):
+        self.samples = []
+
+    def __call__(self, unit, fc, args, start, end, ok):
+        self.samples.append((fc, end - start, sum(pld.frame_bytes(fc, args)), ok))
+
+@twisted.internet.defer.inlineCallbacks
+def refresh(pid):
+    for name in sorted(tabs):
+        yield pid.block_read(tabs[name], fresh=True)
+    for n in [ 'PV', 'dSV', 'OUT', 'Pr+t' ]:
+        yield pid.holding_read(n, fresh=True)
+    yield pid.flags(fresh=True)
+
+@twisted.internet.defer.inlineCallbacks
+def program(pid):
+    steps = [ (i % 9, ('Run', 10 + i), 100 + i) for i in range(63) ] + [ (0, 'Pause', 0) ]
+    yield pid.write_program(steps)
+
+@twisted.internet.defer.inlineCallbacks
+def monitor(pid):
+    # One cycle of the shared poller behind the monitor window.
+    for i in range(10):
+        yield pid.block_read([ 'Pr+t', 'PV', 'dSV', 'OUT' ], priority=pld.POLL, fresh=True)
+        yield pid.flags(priority=pld.POLL, fresh=True)
+
+@twisted.internet.defer.inlineCallbacks
+def restore(pid):
+    image = yield pid.snapshot()
+    changed = dict(image)
+    for n in [ 'AL1', 'AL2', 'P1', 'I1', 'Sv01', 'Sv32', 'Sv64' ]:
+        changed[n] = pld.codecs[n].range[0] + 1
+    yield pid.restore(changed)
+    yield pid.restore(image)
+
+workloads = [ ('refresh', refresh), ('program', program),
+              ('monitor', monitor), ('restore', restore) ]
+
+@twisted.internet.defer.inlineCallbacks
+def run(pid, names, repeat):
+    results = {}
+    for name, func in workloads:
+        if names and name not in names:
+            continue
+        rec = Recorder()
+        pid.bus.tracer = rec
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            yield func(pid)
+            times.append(time.time() - start)
+        pid.bus.tracer = None
+        latency = [ s[1] for s in rec.samples ]
+        total = sum(times)
+        results[name] = {
+            'runs': repeat,
+            'time_mean': total / repeat,
+            'time_min': min(times),
+            'transactions': len(rec.samples) / repeat,
+            'tps': len(rec.samples) / total if total else None,
+            'bytes': sum(s[2] for s in rec.samples) / repeat,
+            'failures': sum(1 for s in rec.samples if not s[3]),
+            'p50': percentile(latency, 50),
+            'p95': percentile(latency, 95),
+            'p99': percentile(latency, 99),
+        }
+    twisted.internet.defer.returnValue(results)
+
+def report(results):
+    print '%-10s %9s %6s %8s %7s %8s %8s %8s' % (
+        'workload', 'time(s)', 'txns', 'txn/s', 'bytes', 'p50(ms)', 'p95(ms)', 'p99(ms)')
+    for name, func in workloads:
+        if name in results:
+            r = results[name]
+            print '%-10s %9.3f %6d %8.1f %7d %8.1f %8.1f %8.1f' % (
+                name, r['time_mean'], r['transactions'], r['tps'] or 0, r['bytes'],
+                r['p50'] * 1000, r['p95'] * 1000, r['p99'] * 1000)
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       stderr=subprocess.STDOUT).strip()
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the SET64rs bus workloads.')
+    parser.add_argument('-p', '--port', help='serial port of a real controller, default is the emulator')
+    parser.add_argument('-b', '--baud', type=int, default=9600)
+    parser.add_argument('-u', '--unit', type=int, default=5)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help='JSON results file')
+    parser.add_argument('workload', nargs='*', help='any of %s, default all' %
+                        ', '.join(w[0] for w in workloads))
+    args = parser.parse_args()
+    for name in args.workload:
+        if name not in dict(workloads):
+            parser.error('unknown workload %s' % name)
+
+    emu = None
+    port = args.port
+    if port is None:
+        import emulator
+        emu = emulator.Emulator([ args.unit ], args.baud)
+        port = emu.path
+    client = pld.SerialModbusClient(port, twisted.internet.reactor,
+                                    baudrate=args.baud, timeout=0.1)
+    pid = client.unit(args.unit)
+    output = args.output or time.strftime('bench-%Y%m%d-%H%M%S.json')
+    status = []
+
+    def done(results):
+        report(results)
+        with open(output, 'w') as f:
+            json.dump({ 'time': time.time(), 'revision': revision(), 'port': args.port,
+                        'baud': args.baud, 'repeat': args.repeat,
+                        'results': results }, f, indent=1, sort_keys=True)
+        print 'saved', output
+
+    def failed(err):
+        status.append(1)
+        print 'benchmark failed:', err.getErrorMessage()
+
+    def start():
+        d = run(pid, args.workload, args.repeat)
+        d.addCallbacks(done, failed)
+        d.addBoth(lambda x: twisted.internet.reactor.stop())
+
+    twisted.internet.reactor.callWhenRunning(start)
+    twisted.internet.reactor.run()
+    sys.exit(status and 1 or 0)
+
+if __name__ == '__main__':
+    main()
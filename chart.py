@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright (C) 2012 Russ Dill <Russ.Dill@asu.edu>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+import numpy
+import twisted.internet.task
+
+try:
+    from matplotlib.backends.backend_gtk3agg import FigureCanvasGTK3Agg as FigureCanvas
+except ImportError:
+    from matplotlib.backends.backend_gtk3cairo import FigureCanvasGTK3Cairo as FigureCanvas
+
+class Trace(object):
+    """Fixed capacity ring buffer of (x, y) samples. Once full, the
+    oldest samples are overwritten."""
+
+    def __init__(self, capacity):
+        self.x = numpy.empty(capacity)
+        self.y = numpy.empty(capacity)
+        self.capacity = capacity
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def last(self, n):
+        return self.y[(self.head - n) % self.capacity]
+
+    def append(self, x, y):
+        # Out of range readings are None, kept as NaN so they draw as a gap.
+        if y is None:
+            y = numpy.nan
+        # Runs of equal values only need their end points.
+        if self.count > 1 and self.last(2) == self.last(1) == y:
+            self.x[(self.head - 1) % self.capacity] = x
+            return
+        self.x[self.head] = x
+        self.y[self.head] = y
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    def data(self):
+        """Returns the samples oldest first."""
+        if self.count < self.capacity:
+            return self.x[:self.count], self.y[:self.count]
+        return (numpy.roll(self.x, -self.head),
+                numpy.roll(self.y, -self.head))
+
+def decimate(x, y, x0, x1, width):
+    """Reduces samples with increasing x to the minimum and maximum of
+    each of width columns between x0 and x1, which draws the same as the
+    full data at that resolution."""
+    width = max(int(width), 1)
+    if len(x) <= 2 * width or x1 <= x0:
+        return x, y
+    col = numpy.clip(((x - x0) * (width / (x1 - x0))).astype(int), 0, width - 1)
+    starts = numpy.flatnonzero(numpy.r_[True, col[1:] != col[:-1]])
+    if len(x) <= 2 * len(starts):
+        return x, y
+    xs = numpy.repeat(x[starts], 2)
+    ys = numpy.column_stack((numpy.minimum.reduceat(y, starts),
+                             numpy.maximum.reduceat(y, starts))).ravel()
+    # Keep the newest sample exact.
+    return numpy.r_[xs, x[-1]], numpy.r_[ys, y[-1]]
+
+class StripChart(object):
+    """Buffers samples for a set of lines and redraws them from a fixed
+    rate tick instead of on every sample. Only the lines are redrawn
+    (blitted) unless the data has left the current view."""
+
+    def __init__(self, figure, interval=0.2, capacity=100000):
+        self.canvas = FigureCanvas(figure)
+        self.traces = {}
+        self.dirty = False
+        self.background = None
+        # Axes whose limits should be fitted to the data from scratch.
+        self.fresh = set()
+        # Cairo canvases can't save and restore regions.
+        self.blit = hasattr(self.canvas, 'copy_from_bbox')
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.interval = interval
+        self.capacity = capacity
+        self.tick = twisted.internet.task.LoopingCall(self.render)
+
+    def add(self, name, line, capacity=None):
+        line.set_animated(self.blit)
+        self.traces[name] = (Trace(capacity or self.capacity), line)
+        self.fresh.add(line.axes)
+
+    def append(self, name, x, y):
+        trace, line = self.traces[name]
+        trace.append(x, y)
+        self.dirty = True
+
+    def clear(self):
+        for trace, line in self.traces.itervalues():
+            trace.clear()
+            self.fresh.add(line.axes)
+        self.dirty = True
+
+    def start(self):
+        if not self.tick.running:
+            self.tick.start(self.interval)
+
+    def stop(self):
+        if self.tick.running:
+            self.tick.stop()
+
+    def on_draw(self, event):
+        if self.blit:
+            self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+            self.draw_lines()
+
+    def draw_lines(self):
+        for trace, line in self.traces.itervalues():
+            line.axes.draw_artist(line)
+        self.canvas.blit(self.canvas.figure.bbox)
+
+    def rescale(self, traces):
+        axes = {}
+        for xs, ys, line in traces:
+            if len(xs):
+                axes.setdefault(line.axes, []).append((xs, ys))
+        rescaled = False
+        for ax, data in axes.iteritems():
+            x0 = min(xs[0] for xs, ys in data)
+            x1 = max(xs[-1] for xs, ys in data)
+            ys = numpy.concatenate([ ys for xs, ys in data ])
+            ys = ys[numpy.isfinite(ys)]
+            changed = ax in self.fresh
+            if changed:
+                self.fresh.discard(ax)
+                ax.set_xlim(x0, x0 + 1)
+            lo, hi = ax.get_xlim()
+            if x1 > hi:
+                # Leave room to grow so the axes don't change every frame,
+                # and drop whatever has fallen out of the ring buffers.
+                lo = max(lo, x0)
+                ax.set_xlim(lo, x1 + max(x1 - lo, 60) * 0.5)
+                changed = True
+            if not len(ys):
+                rescaled = rescaled or changed
+                continue
+            y0, y1 = ys.min(), ys.max()
+            lo, hi = ax.get_ylim()
+            if y0 < lo or y1 > hi or changed:
+                # Fitted to what is left in the ring buffers, so the view
+                # shrinks again once old extremes have been dropped.
+                margin = max(y1 - y0, 1) * 0.1
+                ax.set_ylim(y0 - margin, y1 + margin)
+                changed = True
+            rescaled = rescaled or changed
+        return rescaled
+
+    def render(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        traces = [ trace.data() + (line,) for trace, line in self.traces.itervalues() ]
+        rescaled = self.rescale(traces)
+        for xs, ys, line in traces:
+            lo, hi = line.axes.get_xlim()
+            line.set_data(*decimate(xs, ys, lo, hi, line.axes.bbox.width))
+        if rescaled or not self.blit or self.background is None:
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.draw_lines()
@@ -16,13 +16,68 @@
 import pld
 import sys
 import twisted
+import twisted.internet.defer
 
 coils = [ 'NAT', 'auto', 'manual', 'next', 'pause', 'start', 'end' ]
 
+def load(name):
+    with open(name) as f:
+        return pld.load_snapshot(f)
+
+def save(image, name, unit_id):
+    with open(name, 'w') as f:
+        pld.save_snapshot(f, image, unit_id)
+    return '%d registers saved to %s' % (len(image), name)
+
+@twisted.internet.defer.inlineCallbacks
+def probe(pid, count):
+    # Exercise the link like the status tab does, then report on it.
+    for i in range(count):
+        for n in [ 'PV', 'dSV', 'OUT', 'Pr+t' ]:
+            try:
+                yield pid.holding_read(n, fresh=True)
+            except pld.TimeoutError:
+                pass
+        yield pid.flags(fresh=True)
+    twisted.internet.defer.returnValue(pid.bus.statistics())
+
+def stats(report):
+    lines = [ '%d transactions in %.1fs, %.1f/s, %.1f%% bus utilization, %d bytes' % (
+                report['transactions'], report['elapsed'], report['tps'],
+                report['utilization'], report['bytes']),
+              '%d timeouts, %d resets, %d CRC errors, %d bytes discarded' % (
+                report['timeouts'], report['resets'], report['crc_errors'],
+                report['discarded']),
+              'queue max %d, wait mean %.1fms max %.1fms, %d requests merged' % (
+                report['queue_max'], report['queue_wait'] * 1000, report['queue_wait_max'] * 1000,
+                report['coalesced']) ]
+    for title in [ 'fc', 'unit', 'register' ]:
+        for key, c in sorted(report[title].iteritems()):
+            lines.append('%-8s %-10s %6d %4d timeouts %7.1fms' % (
+                title, key, c['count'], c['timeouts'], c['mean'] * 1000))
+    return '\n'.join(lines)
+
 def action(pid):
     reg = sys.argv[1]
+    if reg == 'stats':
+        d = probe(pid, int(sys.argv[2]) if len(sys.argv) > 2 else 10)
+        d.addCallback(stats)
+        d.addCallbacks(done, failed)
+        return
+    elif reg == 'snapshot':
+        d = pid.snapshot()
+        d.addCallback(save, sys.argv[2], pid.unit_id)
+        d.addCallbacks(done, failed)
+        return
+    elif reg == 'restore':
+        d = twisted.internet.defer.maybeDeferred(load, sys.argv[2])
+        d.addCallback(pid.restore, comm=sys.argv[3:] == ['comm'])
+        d.addCallbacks(done, failed)
+        return
     try:
         reg = int(reg, 0)
+        if reg in pld.by_address:
+            reg = pld.by_address[reg].name
     except:
         pass
     if len(sys.argv) > 2:
@@ -45,9 +100,30 @@ def err(error):
     print 'timeout'
     twisted.internet.reactor.stop()
 
+def failed(error):
+    print 'failed:', error.getErrorMessage()
+    twisted.internet.reactor.stop()
+
+def usage():
+    if len(sys.argv) < 2:
+        return 'register [value] | flags | %s | stats [count] | snapshot file | restore file [comm]' % \
+            ' | '.join(coils)
+    if sys.argv[1] in ('snapshot', 'restore') and len(sys.argv) < 3:
+        return '%s file' % sys.argv[1]
+    if sys.argv[1] == 'stats' and len(sys.argv) > 2 and not sys.argv[2].isdigit():
+        return 'stats [count]'
+    return None
+
 def main():
-    port = pld.SerialModbusClient("/dev/ttyUSB0", twisted.internet.reactor, timeout=0.1)
-    twisted.internet.reactor.callLater(0, action, port.protocol)
+    gateway = None
+    if sys.argv[1:2] in (['-g'], ['--gateway']) and len(sys.argv) > 2:
+        gateway = sys.argv[2]
+        del sys.argv[1:3]
+    if usage():
+        print 'usage: %s [--gateway host:port] %s' % (sys.argv[0], usage())
+        sys.exit(2)
+    port = pld.connect(twisted.internet.reactor, gateway=gateway)
+    twisted.internet.reactor.callLater(0, action, port.unit())
     twisted.internet.reactor.run()
 
 if __name__ == '__main__':
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright (C) 2012 Russ Dill <Russ.Dill@asu.edu>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+# Headless acquisition. Polls registers and status flags from one or more
+# controllers and appends them to a run log per unit per day.
+
+import argparse
+import os
+import time
+import twisted.internet.defer
+import twisted.internet.reactor
+import pld
+import runlog
+
+default_regs = [ 'PV', 'dSV', 'OUT', 'Pr+t', 'flags' ]
+
+def columns(regs):
+    ret = []
+    for n in regs:
+        if n == 'flags':
+            ret.append(('flags', 1))
+        elif n == 'Pr+t':
+            ret += [('step', 1), ('step_t', 1)]
+        else:
+            ret.append((n, 100))
+    return ret
+
+def check_reg(n):
+    if n not in ('flags', 'Pr+t') and \
+            (n not in pld.codecs or type(pld.codecs[n].range) is not tuple):
+        raise argparse.ArgumentTypeError('%s is not a numeric register' % n)
+    return n
+
+class Logger(object):
+    """Polls one unit and writes a row per cycle, starting a new log file
+    each day."""
+
+    def __init__(self, pid, regs, directory, interval):
+        self.pid = pid
+        self.flags = 'flags' in regs
+        self.regs = [ n for n in regs if n != 'flags' ]
+        self.columns = columns(regs)
+        self.directory = directory
+        self.interval = interval
+        self.day = None
+        self.log = None
+        self.run = True
+        self.rows = 0
+        self.errors = 0
+
+    def rotate(self):
+        day = time.strftime('%Y%m%d')
+        if day != self.day:
+            self.close()
+            self.day = day
+            name = 'daemon-%d-%s.run' % (self.pid.unit_id, day)
+            self.log = runlog.Writer(os.path.join(self.directory, name), self.columns,
+                                     kind='daemon', unit=self.pid.unit_id)
+
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+
+    def sample(self, values, flags):
+        row = []
+        for n in self.regs:
+            val = values[n][0]
+            if n == 'Pr+t':
+                row += [None, None] if val is None else list(val)
+            else:
+                row.append(val)
+        if self.flags:
+            row.append(runlog.pack_bits(flags, pld.bits))
+        return row
+
+    @twisted.internet.defer.inlineCallbacks
+    def loop(self):
+        while self.run:
+            start = time.time()
+            wait = self.interval
+            try:
+                values = yield self.pid.block_read(self.regs, suppress=True, priority=pld.POLL)
+                flags = None
+                if self.flags:
+                    flags = yield self.pid.flags(priority=pld.POLL, fresh=True)
+                if self.run:
+                    self.rotate()
+                    self.log.append(time.time(), *self.sample(values, flags))
+                    self.rows += 1
+            except Exception, e:
+                self.errors += 1
+                print 'unit %d: %s' % (self.pid.unit_id, e or type(e).__name__)
+                # Don't spin on a dead link.
+                wait = max(wait, 1.0)
+
+            wait -= time.time() - start
+            if wait > 0 and self.run:
+                d = twisted.internet.defer.Deferred()
+                twisted.internet.reactor.callLater(wait, d.callback, None)
+                yield d
+
+    def stop(self):
+        self.run = False
+        self.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Log SET64rs controllers without a GUI.')
+    parser.add_argument('-p', '--port', default='/dev/ttyUSB0')
+    parser.add_argument('-b', '--baud', type=int, default=9600)
+    parser.add_argument('-g', '--gateway', help='use gateway.py at host:port instead of the port')
+    parser.add_argument('-u', '--unit', type=int, action='append',
+                        help='unit id, may be repeated (default 5)')
+    parser.add_argument('-i', '--interval', type=float, default=0,
+                        help='seconds between samples, 0 polls as fast as the bus allows')
+    parser.add_argument('-d', '--dir', default=runlog.run_dir,
+                        help='directory for the daily logs')
+    parser.add_argument('regs', nargs='*', type=check_reg, default=default_regs,
+                        help='numeric registers, Pr+t or flags (default %s)' % ' '.join(default_regs))
+    args = parser.parse_args()
+
+    port = pld.connect(twisted.internet.reactor, args.port, args.baud, args.gateway)
+    loggers = [ Logger(port.unit(u), args.regs, args.dir, args.interval)
+                for u in args.unit or [5] ]
+    for l in loggers:
+        twisted.internet.reactor.callWhenRunning(l.loop)
+        twisted.internet.reactor.addSystemEventTrigger('before', 'shutdown', l.stop)
+    twisted.internet.reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright (C) 2012 Russ Dill <Russ.Dill@asu.edu>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+# SET64rs emulator. Serves the register map in pld over Modbus RTU on a
+# pseudo terminal, with a first order plus dead time plant behind the
+# controller's PID, ramp/soak program and auto-tune.
+
+import argparse
+import collections
+import math
+import os
+import struct
+import tty
+import twisted.internet.protocol
+import twisted.internet.reactor
+import twisted.internet.stdio
+import twisted.internet.task
+from pymodbus.utilities import computeCRC
+import pld
+
+# Registers the controller computes, writes to these are refused.
+live = [ 'PV', 'dSV', 'Pr+t' ]
+
+def signed(word):
+    return word - 0x10000 if word > 0x7fff else word
+
+def crc(data):
+    return struct.pack('>H', computeCRC(data))
+
+class Plant(object):
+    """First order plus dead time process: gain degrees at 100% output
+    above ambient, time constant tau and dead time in seconds."""
+
+    def __init__(self, gain=400.0, tau=120.0, dead=10.0, ambient=25.0):
+        self.gain = gain
+        self.tau = tau
+        self.dead = dead
+        self.ambient = ambient
+        self.temp = ambient
+        self.now = 0.0
+        self.history = collections.deque([(0.0, 0.0)])
+
+    def step(self, out, dt):
+        self.now += dt
+        self.history.append((self.now, out))
+        # Keep just the output that is now taking effect and what follows.
+        while len(self.history) > 1 and self.history[1][0] <= self.now - self.dead:
+            self.history.popleft()
+        target = self.ambient + self.gain * self.history[0][1] / 100.0
+        self.temp += (target - self.temp) * (1 - math.exp(-dt / self.tau))
+        return self.temp
+
+class Device(object):
+    """Register image and control logic of one controller."""
+
+    def __init__(self, unit_id=5, plant=None):
+        self.plant = plant or Plant()
+        self.values = {}
+        for n, r in pld.codecs.iteritems():
+            if r.default is not None:
+                self.values[n] = self.raw(n, r.default)
+        self.values['Id'] = unit_id
+        self.values['OUT'] = 0.0
+        self.values['dSV'] = self.values['SV']
+        self.manual = False
+        self.running = False
+        self.paused = False
+        self.step = int(self.values['PrL'])
+        self.step_t = 0.0
+        self.ramp_from = self.plant.temp
+        self.integral = 0.0
+        self.last_pv = None
+        self.relays = {}
+        self.at = None
+
+    def raw(self, n, value):
+        """Internal number for a register value given as in pld."""
+        r = pld.codecs[n]
+        if type(r.range) is tuple:
+            return float(value)
+        val = r.encode(value)
+        return 0 if val is None else val
+
+    def exponent(self, n):
+        mult = pld.codecs[n].mult
+        # The live temperatures follow the decimal point like SV.
+        if mult is None or n in ('PV', 'dSV'):
+            return int(self.values.get('dot', 0))
+        return int(round(-math.log10(mult)))
+
+    def pv(self):
+        return self.plant.temp + self.values['Psb']
+
+    def read(self, addr):
+        r = pld.by_address[addr]
+        if r.name == 'Pr+t':
+            t = int(self.step_t)
+            return [ (self.step << 8) | (t >> 8), (t & 0xff) << 8 ]
+        if r.name == 'PV':
+            val = self.pv()
+        else:
+            val = self.values.get(r.name, 0)
+        exp = self.exponent(r.name)
+        return [ int(round(val * 10**exp)) & 0xffff, exp ]
+
+    def write(self, addr, words):
+        """Returns a Modbus exception code or None."""
+        r = pld.by_address.get(addr)
+        if r is None or r.name in live:
+            return 2
+        if r.name == 'OUT':
+            # The client sends OUT in tenths, offset by one.
+            value = (signed(words[0]) - 1) * 10.0**-words[1]
+            if not self.manual:
+                return None
+        else:
+            value = signed(words[0]) * 10.0**-(words[1] or self.exponent(r.name))
+        if type(r.range) is tuple and not r.range[0] <= value <= r.range[1]:
+            return 3
+        if type(r.range) is list and not 0 <= value < len(r.range):
+            return 3
+        self.values[r.name] = value
+        if r.name == 'At':
+            self.tune(value)
+        return None
+
+    def tune(self, on):
+        # Auto-tune only runs in constant SV mode.
+        if on and self.values['ModL'] == 0:
+            self.at = { 'crossings': [], 'lo': None, 'hi': None, 'above': None, 'amp': 0 }
+            self.values['At'] = 1
+        else:
+            self.at = None
+            self.values['At'] = 0
+
+    def coil(self, addr, on):
+        if addr == 0:
+            self.tune(on)
+        elif addr == 1:
+            self.manual = on
+        elif addr == 2:
+            if on:
+                self.paused = not self.paused
+            else:
+                self.next_step()
+        elif addr == 3:
+            if on:
+                self.running = False
+            else:
+                self.running = True
+                self.paused = False
+                self.enter(int(self.values['PrL']))
+        else:
+            return 2
+        return None
+
+    def bits(self):
+        pv = self.pv()
+        sv = self.values['dSV']
+        flags = { 'A/M': self.manual, 'R/D': bool(self.values['rd']),
+                  'abnormal': not self.values['PvL'] <= pv <= self.values['PvH'],
+                  'AT': self.at is not None }
+        for al in [ 'AL1', 'AL2' ]:
+            mode = pld.alarm_modes[int(self.values[al + 'y'])] or ''
+            lim = self.values[al]
+            if mode.startswith('High'):
+                flags[al] = pv > lim
+            elif mode.startswith('Low'):
+                flags[al] = pv < lim
+            elif mode.startswith('Deviation high/low') or mode.startswith('Band'):
+                flags[al] = abs(pv - sv) > lim
+            elif mode.startswith('Deviation high'):
+                flags[al] = pv - sv > lim
+            elif mode.startswith('Deviation low'):
+                flags[al] = sv - pv > lim
+        return [ bool(flags.get(b)) for b in pld.bits ]
+
+    def enter(self, step):
+        self.step = int(step)
+        self.step_t = 0.0
+        self.ramp_from = self.values['dSV']
+
+    def next_step(self):
+        if self.step >= self.values['PrH']:
+            self.running = False
+        else:
+            self.enter(self.step + 1)
+
+    def program(self, dt):
+        """Advances the ramp/soak program and returns the set value."""
+        mode = pld.registers['ModL'][2][int(self.values['ModL'])]
+        if mode == 'SV' or not self.running:
+            return self.values['SV'] if mode == 'SV' else self.values['dSV']
+        sv = self.values['Sv%02d' % self.step]
+        t = int(self.values['t-%02d' % self.step])
+        if t < -64:
+            # Relay events take no time.
+            self.relays[-t // 10 % 10] = -t % 10
+            self.next_step()
+            return self.ramp_from
+        elif t < 0:
+            self.enter(-t)
+            return self.ramp_from
+        elif t == 0 or self.paused:
+            return self.values['dSV']
+
+        units = 60.0 if mode.startswith('M') else 1.0
+        self.step_t += dt / units
+        if mode.endswith('PV'):
+            if abs(self.pv() - sv) <= 1:
+                self.next_step()
+            return sv
+        if self.step_t >= t:
+            self.next_step()
+            return sv
+        return self.ramp_from + (sv - self.ramp_from) * self.step_t / t
+
+    def pid(self):
+        if self.values['ModL'] == 0 or not self.running:
+            return self.values['P'], self.values['I'], self.values['d']
+        n = int(self.values['C-%02d' % self.step]) + 1
+        return self.values['P%d' % n], self.values['I%d' % n], self.values['d%d' % n]
+
+    def autotune(self, pv, sv, lo, hi):
+        """Relay auto-tune, sets P, I and d from the ultimate gain and
+        period once the oscillation has settled."""
+        at = self.at
+        above = pv > sv
+        at['lo'] = pv if at['lo'] is None else min(at['lo'], pv)
+        at['hi'] = pv if at['hi'] is None else max(at['hi'], pv)
+        if above and at['above'] is False:
+            at['crossings'].append(self.plant.now)
+            # Only the last full cycle counts for the amplitude.
+            at['amp'] = (at['hi'] - at['lo']) / 2
+            at['lo'] = at['hi'] = pv
+        at['above'] = above
+        if len(at['crossings']) >= 4:
+            period = (at['crossings'][-1] - at['crossings'][-3]) / 2
+            amp = max(at['amp'], 0.1)
+            ku = 4 * (hi - lo) / 2 / (math.pi * amp)
+            self.values['P'] = min(max(100 / (0.6 * ku), 0.1), 300.0)
+            self.values['I'] = min(max(period / 2, 0), 2000)
+            self.values['d'] = min(max(period / 8, 0), 999)
+            self.values['At'] = 0
+            self.at = None
+        return lo if above else hi
+
+    def update(self, dt):
+        sv = self.program(dt)
+        self.values['dSV'] = sv
+        pv = self.pv()
+        lo, hi = self.values['outL'], self.values['outH']
+        if self.manual:
+            out = self.values['OUT']
+        elif self.at is not None:
+            out = self.autotune(pv, sv, lo, hi)
+        else:
+            P, I, d = self.pid()
+            err = sv - pv if self.values['rd'] == 0 else pv - sv
+            rate = 0 if self.last_pv is None else (pv - self.last_pv) / dt
+            if self.values['rd']:
+                rate = -rate
+            if abs(err) > self.values['bb']:
+                out = hi if err > 0 else lo
+            else:
+                integral = self.integral + (err * dt / I if I else 0)
+                out = 100.0 / P * (err + integral - d * rate)
+                # Only integrate while the output isn't saturated.
+                if lo <= out <= hi:
+                    self.integral = integral
+            out = min(max(out, lo), hi)
+        self.last_pv = pv
+        self.values['OUT'] = out
+        self.plant.step(out, dt)
+
+class Slave(twisted.internet.protocol.Protocol):
+    """RTU slave for one or more devices on the same line."""
+
+    def __init__(self, devices, baudrate=None, turnaround=0.01):
+        self.devices = devices
+        self.baudrate = baudrate
+        self.turnaround = turnaround
+        self.buf = ''
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.frames = 0
+        self.crc_errors = 0
+
+    def frame_length(self):
+        fc = ord(self.buf[1])
+        if fc == 16:
+            if len(self.buf) < 7:
+                return None
+            return 9 + ord(self.buf[6])
+        return 8
+
+    def dataReceived(self, data):
+        self.rx_bytes += len(data)
+        self.buf += data
+        while len(self.buf) >= 2:
+            n = self.frame_length()
+            if n is None or len(self.buf) < n:
+                break
+            frame, rest = self.buf[:n], self.buf[n:]
+            if crc(frame[:-2]) != frame[-2:]:
+                # Resynchronise a byte at a time.
+                self.crc_errors += 1
+                self.buf = self.buf[1:]
+                continue
+            self.buf = rest
+            self.frames += 1
+            self.handle(frame[:-2])
+
+    def device(self, unit):
+        for dev in self.devices:
+            if int(dev.values['Id']) == unit:
+                return dev
+        return None
+
+    def handle(self, frame):
+        unit, fc = ord(frame[0]), ord(frame[1])
+        dev = self.device(unit)
+        if dev is None:
+            return
+        err = None
+        if fc == 1:
+            addr, count = struct.unpack('>HH', frame[2:6])
+            bits = dev.bits()[addr:addr+count]
+            data = ''.join(chr(sum(1 << j for j, b in enumerate(bits[i:i+8]) if b))
+                           for i in range(0, len(bits), 8))
+            pdu = chr(len(data)) + data
+        elif fc == 3:
+            addr, count = struct.unpack('>HH', frame[2:6])
+            words = []
+            if count % 2 or count > 125:
+                err = 3
+            for i in range(count // 2):
+                if addr + i not in pld.by_address:
+                    err = 2
+                    break
+                words += dev.read(addr + i)
+            pdu = chr(2 * len(words)) + struct.pack('>%dH' % len(words), *words)
+        elif fc == 5:
+            addr, value = struct.unpack('>HH', frame[2:6])
+            err = dev.coil(addr, value == 0xff00)
+            pdu = frame[2:6]
+        elif fc == 16:
+            addr, count = struct.unpack('>HH', frame[2:6])
+            words = struct.unpack('>%dH' % count, frame[7:7+2*count])
+            for i in range(count // 2):
+                err = dev.write(addr + i, words[2*i:2*i+2])
+                if err:
+                    break
+            pdu = frame[2:6]
+        else:
+            err = 1
+        if err:
+            fc |= 0x80
+            pdu = chr(err)
+        reply = chr(unit) + chr(fc) + pdu
+        reply += crc(reply)
+        delay = self.turnaround
+        if self.baudrate:
+            delay += len(reply) * 11.0 / self.baudrate
+        twisted.internet.reactor.callLater(delay, self.send, reply)
+
+    def send(self, reply):
+        self.tx_bytes += len(reply)
+        self.transport.write(reply)
+
+class Emulator(object):
+    """Runs devices on a new pseudo terminal. speed is simulated seconds
+    per real second."""
+
+    def __init__(self, units=[5], baudrate=None, speed=1.0, tick=0.1, **kwargs):
+        self.devices = [ Device(u) for u in units ]
+        self.slave = Slave(self.devices, baudrate, **kwargs)
+        self.master, self.slave_fd = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave_fd)
+        self.path = os.ttyname(self.slave_fd)
+        self.io = twisted.internet.stdio.StandardIO(self.slave, self.master, os.dup(self.master))
+        self.speed = speed
+        self.tick = tick
+        self.loop = twisted.internet.task.LoopingCall(self.update)
+        self.loop.start(tick, now=False)
+
+    def update(self):
+        for dev in self.devices:
+            dev.update(self.tick * self.speed)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+        self.io.loseConnection()
+        os.close(self.slave_fd)
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulate SET64rs controllers on a pseudo terminal.')
+    parser.add_argument('-u', '--unit', type=int, action='append',
+                        help='unit id, may be repeated (default 5)')
+    parser.add_argument('-b', '--baud', type=int, default=None,
+                        help='delay replies as if sent at this baud rate')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='simulated seconds per second')
+    parser.add_argument('-l', '--link', help='also make the terminal available at this path')
+    args = parser.parse_args()
+
+    emu = Emulator(args.unit or [5], args.baud, args.speed)
+    if args.link:
+        if os.path.lexists(args.link):
+            os.unlink(args.link)
+        os.symlink(emu.path, args.link)
+    print 'serving on', emu.path
+    twisted.internet.reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright (C) 2012 Russ Dill <Russ.Dill@asu.edu>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+# Modbus TCP to RTU gateway. Owns the serial link and queues requests from
+# any number of TCP clients onto the bus scheduler. Reads are answered from
+# a short lived cache, and identical reads already on their way to the
+# device are shared.
+
+import argparse
+import struct
+import sys
+import twisted.internet.defer
+import twisted.internet.protocol
+import twisted.internet.reactor
+import twisted.python.failure
+import pymodbus.pdu
+import pld
+
+mbap = struct.Struct('>HHHB')
+
+# Modbus exception codes
+ILLEGAL_FUNCTION = 1
+ILLEGAL_VALUE = 3
+TARGET_FAILED = 0x0b
+
+class Gateway(object):
+    def __init__(self, bus, ttl=0.5):
+        self.bus = bus
+        self.ttl = ttl
+        # (unit, fc, addr, count) -> (expiry, pdu)
+        self.cache = {}
+        # (unit, fc, addr, count, generation) -> [Deferred] waiting on the
+        # same read
+        self.inflight = {}
+        # unit -> count of writes submitted and completed. Reads started
+        # before a write finished are neither cached nor joined after it.
+        self.generation = {}
+        self.hits = 0
+        self.misses = 0
+
+    def request(self, unit, pdu):
+        """Returns a Deferred firing with the response PDU for pdu."""
+        fc = ord(pdu[0])
+        try:
+            if fc in (1, 3):
+                addr, count = struct.unpack('>HH', pdu[1:5])
+                return self.read(unit, fc, addr, count)
+            elif fc == 5:
+                addr, value = struct.unpack('>HH', pdu[1:5])
+                if value not in (0, 0xff00):
+                    return twisted.internet.defer.succeed(exception(fc, ILLEGAL_VALUE))
+                return self.write(unit, fc, pdu[:5], self.bus.write_coil, addr, value == 0xff00)
+            elif fc == 6:
+                addr, value = struct.unpack('>HH', pdu[1:5])
+                return self.write(unit, fc, pdu[:5], self.bus.write_register, addr, value)
+            elif fc == 16:
+                addr, count, n = struct.unpack('>HHB', pdu[1:6])
+                if n != 2 * count or len(pdu) < 6 + n:
+                    return twisted.internet.defer.succeed(exception(fc, ILLEGAL_VALUE))
+                values = list(struct.unpack('>%dH' % count, pdu[6:6+n]))
+                return self.write(unit, fc, pdu[:5], self.bus.write_registers, addr, values)
+        except struct.error:
+            return twisted.internet.defer.succeed(exception(fc, ILLEGAL_VALUE))
+        return twisted.internet.defer.succeed(exception(fc, ILLEGAL_FUNCTION))
+
+    def read(self, unit, fc, addr, count):
+        key = (unit, fc, addr, count)
+        now = twisted.internet.reactor.seconds()
+        if key in self.cache and self.cache[key][0] > now:
+            self.hits += 1
+            return twisted.internet.defer.succeed(self.cache[key][1])
+        self.misses += 1
+        gen = self.generation.get(unit, 0)
+        d = twisted.internet.defer.Deferred()
+        if key + (gen,) in self.inflight:
+            self.inflight[key + (gen,)].append(d)
+            return d
+        self.inflight[key + (gen,)] = [d]
+        func = self.bus.read_coils if fc == 1 else self.bus.read_holding_registers
+        r = self.bus.submit(unit, pld.READ, self.forward, unit, fc, func, addr, count)
+        r.addBoth(self.read_done, key, gen)
+        return d
+
+    def read_done(self, result, key, gen):
+        if not isinstance(result, twisted.python.failure.Failure) and ord(result[0]) < 0x80 \
+                and gen == self.generation.get(key[0], 0):
+            self.cache[key] = (twisted.internet.reactor.seconds() + self.ttl, result)
+        for d in self.inflight.pop(key + (gen,)):
+            if isinstance(result, twisted.python.failure.Failure):
+                d.callback(exception(key[1], TARGET_FAILED))
+            else:
+                d.callback(result)
+
+    def invalidate(self, unit, result=None):
+        # A write can change any register of the unit, the scale words of
+        # others included.
+        self.generation[unit] = self.generation.get(unit, 0) + 1
+        for key in self.cache.keys():
+            if key[0] == unit:
+                del self.cache[key]
+        return result
+
+    def write(self, unit, fc, echo, func, *args):
+        self.invalidate(unit)
+        d = self.bus.submit(unit, pld.WRITE, self.forward, unit, fc, func, *args)
+        # Again once written, reads that were on the wire meanwhile may
+        # have cached the old value.
+        d.addBoth(lambda result: self.invalidate(unit, result))
+        d.addCallback(lambda pdu: echo if ord(pdu[0]) == fc else pdu)
+        d.addErrback(lambda x: exception(fc, TARGET_FAILED))
+        return d
+
+    @twisted.internet.defer.inlineCallbacks
+    def forward(self, unit, fc, func, *args):
+        # Writes are left for the TCP client to retry.
+        if fc in (1, 3):
+            response = yield self.bus.read(fc, func, *args, unit=unit)
+        else:
+            response = yield self.bus.transact(fc, func, *args, unit=unit)
+        if isinstance(response, pymodbus.pdu.ExceptionResponse):
+            twisted.internet.defer.returnValue(exception(fc, response.exception_code))
+        if fc == 1:
+            bits = response.bits[:args[1]]
+            data = ''.join(chr(sum(1 << j for j, b in enumerate(bits[i:i+8]) if b))
+                           for i in range(0, len(bits), 8))
+            pdu = chr(fc) + chr(len(data)) + data
+        elif fc == 3:
+            data = struct.pack('>%dH' % len(response.registers), *response.registers)
+            pdu = chr(fc) + chr(len(data)) + data
+        else:
+            pdu = chr(fc)
+        twisted.internet.defer.returnValue(pdu)
+
+def exception(fc, code):
+    return chr(fc | 0x80) + chr(code)
+
+class GatewayProtocol(twisted.internet.protocol.Protocol):
+    def __init__(self):
+        self.buf = ''
+
+    def dataReceived(self, data):
+        self.buf += data
+        while len(self.buf) >= mbap.size:
+            tid, proto, length, unit = mbap.unpack_from(self.buf)
+            if proto != 0 or length < 2:
+                self.transport.loseConnection()
+                return
+            end = mbap.size - 1 + length
+            if len(self.buf) < end:
+                break
+            pdu = self.buf[mbap.size:end]
+            self.buf = self.buf[end:]
+            d = self.factory.gateway.request(unit, pdu)
+            d.addCallback(self.reply, tid, unit)
+
+    def reply(self, pdu, tid, unit):
+        if self.transport.connected:
+            self.transport.write(mbap.pack(tid, 0, len(pdu) + 1, unit) + pdu)
+
+class GatewayFactory(twisted.internet.protocol.ServerFactory):
+    protocol = GatewayProtocol
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+def serve(bus, port=5020, interface='127.0.0.1', ttl=0.5):
+    """Serves bus on a TCP port, returns the Gateway."""
+    gateway = Gateway(bus, ttl)
+    gateway.port = twisted.internet.reactor.listenTCP(port, GatewayFactory(gateway),
+                                                      interface=interface)
+    return gateway
+
+@twisted.internet.defer.inlineCallbacks
+def check():
+    """Runs two clients through a gateway on localhost against the
+    emulator, returns the number of failed checks."""
+    import emulator
+    emu = emulator.Emulator([ 5 ], 9600)
+    port = pld.SerialModbusClient(emu.path, twisted.internet.reactor, baudrate=9600, timeout=0.1)
+    gateway = serve(port.protocol, 0)
+    addr = '127.0.0.1:%d' % gateway.port.getHost().port
+    clients = [ pld.connect(twisted.internet.reactor, gateway=addr).unit(5) for i in range(2) ]
+    direct = port.unit(5)
+    failed = []
+
+    def expect(what, ok):
+        print '%-50s %s' % (what, 'ok' if ok else 'FAILED')
+        if not ok:
+            failed.append(what)
+
+    regs = [ 'SV', 'AL1', 'P', 'I', 'd', 'dot', 'PV' ]
+    before = port.protocol.stats.transactions
+    local = yield direct.block_read(regs, fresh=True)
+    single = port.protocol.stats.transactions - before
+    before = port.protocol.stats.transactions
+    results = yield twisted.internet.defer.gatherResults(
+        [ c.block_read(regs, fresh=True) for c in clients ])
+    expect('two clients read the same values', results[0] == results[1])
+    expect('their identical reads were shared on the serial link',
+           port.protocol.stats.transactions - before == single)
+    expect('values match a direct read', dict((n, local[n]) for n in regs if n != 'PV') ==
+           dict((n, results[0][n]) for n in regs if n != 'PV'))
+
+    before = gateway.hits
+    yield clients[1].holding_read('SV', fresh=True)
+    yield clients[1].holding_read('SV', fresh=True)
+    expect('repeated reads are answered from the cache', gateway.hits > before)
+
+    sv = pld.codecs['SV'].range[0] + 10
+    written = yield clients[0].raw('SV', sv)
+    read = yield clients[1].holding_read('SV', fresh=True)
+    expect('a write by one client is seen by the other', written[0] == sv and read[0] == sv)
+
+    # A read on the wire when a write is queued mustn't answer reads
+    # made after the write.
+    reg = struct.pack('>HH', pld.codecs['SV'].addr, 2)
+    value, scale = struct.unpack('>HH', (yield gateway.request(5, '\x03' + reg))[2:6])
+    write = lambda value: gateway.request(5, '\x10' + reg + struct.pack('>BHH', 4, value, scale))
+    yield write(value + 1)
+    early = gateway.request(5, '\x03' + reg)
+    yield write(value + 2)
+    late = yield gateway.request(5, '\x03' + reg)
+    yield early
+    yield write(value)
+    expect('a read after a write sees the new value', late[2:4] == struct.pack('>H', value + 2))
+
+    try:
+        yield pld.connect(twisted.internet.reactor, gateway=addr).unit(7).holding_read('SV')
+        expect('a missing unit times out', False)
+    except pld.TimeoutError:
+        expect('a missing unit times out', True)
+
+    emu.stop()
+    twisted.internet.defer.returnValue(len(failed))
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a SET64rs RS-485 bus over Modbus TCP.')
+    parser.add_argument('-p', '--port', default='/dev/ttyUSB0')
+    parser.add_argument('-b', '--baud', type=int, default=9600)
+    parser.add_argument('-l', '--listen', type=int, default=5020, help='TCP port')
+    parser.add_argument('-i', '--interface', default='127.0.0.1')
+    parser.add_argument('-t', '--ttl', type=float, default=0.5,
+                        help='seconds a read is answered from the cache')
+    parser.add_argument('--check', action='store_true',
+                        help='test the gateway on localhost against the emulator and exit')
+    args = parser.parse_args()
+
+    if args.check:
+        status = []
+        def start():
+            d = check()
+            d.addCallback(status.append)
+            d.addErrback(lambda err: status.append(1) or err.printTraceback())
+            d.addBoth(lambda x: twisted.internet.reactor.stop())
+        twisted.internet.reactor.callWhenRunning(start)
+        twisted.internet.reactor.run()
+        sys.exit(1 if status != [0] else 0)
+
+    port = pld.SerialModbusClient(args.port, twisted.internet.reactor,
+                                  baudrate=args.baud, timeout=0.1)
+    serve(port.protocol, args.listen, args.interface, args.ttl)
+    twisted.internet.reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright (C) 2012 Russ Dill <Russ.Dill@asu.edu>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+# Start up benchmark. Imports each entry point in a fresh interpreter and
+# reports how long it took and which heavy packages came along with it.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+modules = [ 'pld', 'cmd', 'daemon', 'gateway', 'test', 'monitor', 'autotune' ]
+heavy = [ 'gi', 'matplotlib', 'numpy' ]
+
+probe = '''
+import sys, time, json
+start = time.time()
+import %s
+elapsed = time.time() - start
+print json.dumps({ 'time': elapsed, 'loaded': [ m for m in %r if m in sys.modules ],
+                   'modules': len(sys.modules) })
+'''
+
+def measure(name, repeat):
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    result = None
+    for i in range(repeat):
+        out = subprocess.check_output([ sys.executable, '-c', probe % (name, heavy) ],
+                                      cwd=here, stderr=subprocess.STDOUT)
+        result = json.loads(out.strip().splitlines()[-1])
+        times.append(result['time'])
+    times.sort()
+    return { 'median': times[len(times) // 2], 'min': times[0],
+             'loaded': result['loaded'], 'modules': result['modules'] }
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the import time of each entry point.')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('-o', '--output', help='JSON results file')
+    parser.add_argument('module', nargs='*', help='default %s' % ' '.join(modules))
+    args = parser.parse_args()
+
+    results = {}
+    print '%-10s %10s %8s %8s  %s' % ('module', 'median(ms)', 'min(ms)', 'modules', 'heavy')
+    for name in args.module or modules:
+        try:
+            r = measure(name, args.repeat)
+        except subprocess.CalledProcessError, e:
+            print '%-10s failed: %s' % (name, e.output.strip().splitlines()[-1])
+            continue
+        results[name] = r
+        print '%-10s %10.1f %8.1f %8d  %s' % (name, r['median'] * 1000, r['min'] * 1000,
+                                            r['modules'], ' '.join(r['loaded']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({ 'time': time.time(), 'python': sys.version, 'repeat': args.repeat,
+                        'results': results }, f, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -16,21 +16,18 @@
 from gi.repository import Gtk
 import pld
 import time
-import twisted.internet.defer
 import math
 import widgets
-import sys
-import traceback
+import runlog
 
 import matplotlib.figure
 import matplotlib.ticker
-from matplotlib.backends.backend_gtk3cairo import FigureCanvasGTK3Cairo as FigureCanvas
+import chart
 
 class MonitorWindow(Gtk.Window):
     def __init__(self, pid):
         Gtk.Window.__init__(self, title="Monitor")
         self.pid = pid
-        self.restart = False
         main_hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
 
         vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
@@ -44,17 +41,17 @@ class MonitorWindow(Gtk.Window):
         self.out_axes.set_ylabel('OUT (%)')
         self.out_axes.autoscale()
         self.axes.grid()
-        self.pv_x = []
-        self.pv_y = []
-        self.sv_x = []
-        self.sv_y = []
-        self.out_x = []
-        self.out_y = []
-        self.pv_plot, = self.axes.plot(self.pv_x, self.pv_y, 'b--') #b
-        self.sv_plot, = self.axes.plot(self.sv_x, self.sv_y, 'k-') #k
-        self.out_plot, = self.out_axes.plot(self.out_x, self.out_y, 'r:') #r
-
-        self.canvas = FigureCanvas(f)
+        self.pv_plot, = self.axes.plot([], [], 'b--') #b
+        self.sv_plot, = self.axes.plot([], [], 'k-') #k
+        self.out_plot, = self.out_axes.plot([], [], 'r:') #r
+
+        # Samples are buffered by the chart and drawn at a fixed rate so
+        # redraws don't hold up polling.
+        self.chart = chart.StripChart(f)
+        self.chart.add('PV', self.pv_plot)
+        self.chart.add('dSV', self.sv_plot)
+        self.chart.add('OUT', self.out_plot)
+        self.canvas = self.chart.canvas
         self.canvas.set_size_request(800,600)
 
         vbox.add(self.canvas)
@@ -203,93 +200,74 @@ class MonitorWindow(Gtk.Window):
 
         main_hbox.add(table)
 
-        self.run = True
-        self.d = self.loop()
-        self.d.addErrback(lambda x: None)
+        self.start = time.time()
+        self.step = None
+        self.step_t = None
+        self.mode = None
+        self.sample = {}
+        self.log = runlog.new_run('monitor', pid.unit_id)
+        self.subs = [ pid.subscribe(n, 0.3, self.on_sample)
+                      for n in [ 'Pr+t', 'PV', 'dSV', 'OUT', 'flags' ] ]
+        self.changed_id = pid.connect('changed', self.changed)
+        self.chart.start()
         self.connect('delete-event', self.on_delete)
 
     def on_restart(self, widget):
-        self.restart = True
+        self.start = time.time()
+        self.chart.clear()
+        self.log.close()
+        self.log = runlog.new_run('monitor', self.pid.unit_id)
+        self.sample = {}
+        d = self.pid.coil('start')
+        d.addCallback(lambda x: self.pid.coil('auto'))
+        d.addErrback(lambda x: None)
 
     def on_delete(self, widget, event):
-        self.run = False
-
-    @twisted.internet.defer.inlineCallbacks
-    def loop(self):
-        start = time.time()
-        while self.run:
-            if self.restart:
-                start = time.time()
-                self.pv_x = []
-                self.pv_y = []
-                self.sv_x = []
-                self.sv_y = []
-                self.out_x = []
-                self.out_y = []
-                self.axes.relim()
-                self.axes.autoscale()
-                self.canvas.draw()
-                self.restart = False
-                yield self.pid.coil('start')
-                yield self.pid.coil('auto')
-            try:
-
-                val, mult = yield self.pid.holding_read('Pr+t')
-                step, step_t = val
-                val, mult = yield self.pid.holding_read('t-' + ('%02d' % step))
-                step_total = 0
-                if type(val) is tuple:
-                    val, idx = val
-                if val == 'Run':
-                    step_total = idx
-                elif val == 'Jump':
-                    val += ' to ' + str(abs(idx))
-
+        for sub in self.subs:
+            self.pid.unsubscribe(sub)
+        self.pid.disconnect(self.changed_id)
+        self.chart.stop()
+        self.log.close()
+
+    def on_sample(self, n, val, mult):
+        if n == 'Pr+t':
+            step, self.step_t = val
+            if step != self.step:
+                # Later edits of the step's mode arrive through changed.
+                self.step = step
+                self.mode = None
                 self.current_step.set_text(str(step))
-                self.step_time.set_text(str(step_t) + '/' + str(step_total) if val == 'Run' else 'NA')
-                self.status.set_text(val)
-
-                pv, mult = yield self.pid.holding_read('PV')
-                now = time.time() - start
-                if len(self.pv_y) > 1 and self.pv_y[-2] == self.pv_y[-1] == pv:
-                    self.pv_x[-1] = now
-                else:
-                    self.pv_x.append(now)
-                    self.pv_y.append(pv)
-                self.pv_plot.set_data(self.pv_x, self.pv_y)
-                self.axes.relim()
-                self.axes.autoscale()
-                self.canvas.draw()
-
-                sv, mult = yield self.pid.holding_read('dSV')
-                now = time.time() - start
-                if len(self.sv_y) > 1 and self.sv_y[-2] == self.sv_y[-1] == sv:
-                    self.sv_x[-1] = now
-                else:
-                    self.sv_x.append(now)
-                    self.sv_y.append(sv)
-                self.sv_plot.set_data(self.sv_x, self.sv_y)
-                self.axes.relim()
-                self.axes.autoscale()
-                self.canvas.draw()
-
-                out, mult = yield self.pid.holding_read('OUT')
-                now = time.time() - start
-                if len(self.out_y) > 1 and self.out_y[-2] == self.out_y[-1] == out:
-                    self.out_x[-1] = now
-                else:
-                    self.out_x.append(now)
-                    self.out_y.append(out)
-                self.out_plot.set_data(self.out_x, self.out_y)
-                self.out_axes.relim()
-                self.out_axes.autoscale()
-                self.canvas.draw()
-            except Exception, e:
-                print 'monitor error', e
-                traceback.print_exc(file=sys.stdout)
-
-            d = twisted.internet.defer.Deferred()
-            twisted.internet.reactor.callLater(0.300 , d.callback, None)
-            yield d
-
+                n = 't-%02d' % step
+                d = self.pid.holding_read(n, priority=pld.POLL)
+                d.addCallback(lambda val, n=n: self.pid.replay({ n: val }))
+                d.addErrback(lambda x: None)
+            self.show_step()
+        elif n != 'flags':
+            self.chart.append(n, time.time() - self.start, val)
+
+        # Log a row once every subscription has delivered.
+        self.sample[n] = val
+        if len(self.sample) == len(self.subs):
+            self.log.append(time.time(), self.sample['PV'], self.sample['dSV'],
+                self.sample['OUT'], self.step, self.step_t,
+                runlog.pack_bits(self.sample['flags'], pld.bits))
+            self.sample = {}
+
+    def changed(self, pid, n, val, mult):
+        if self.step is not None and n == 't-%02d' % self.step:
+            self.mode = val
+            self.show_step()
+
+    def show_step(self):
+        val = self.mode
+        step_total = 0
+        if type(val) is tuple:
+            val, idx = val
+        if val == 'Run':
+            step_total = idx
+        elif val == 'Jump':
+            val += ' to ' + str(abs(idx))
+
+        self.step_time.set_text(str(self.step_t) + '/' + str(step_total) if val == 'Run' else 'NA')
+        self.status.set_text(str(val))
 
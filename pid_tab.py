@@ -16,6 +16,7 @@
 from gi.repository import Gtk
 import pld
 import twisted.internet.defer
+import widgets
 
 class PID(Gtk.TreeView):
     def __init__(self, pid):
@@ -36,6 +37,7 @@ class PID(Gtk.TreeView):
         renderer.set_property("digits", 1)
         renderer.connect('edited', self.on_p_edited)
         column = Gtk.TreeViewColumn("P                              ", renderer, text=1)
+        column.set_cell_data_func(renderer, widgets.mark_unverified_cell, (pid, 'P%d'))
         self.append_column(column)
 
         reg = pld.registers['I1']
@@ -46,6 +48,7 @@ class PID(Gtk.TreeView):
         renderer.set_property("width-chars", 20)
         renderer.connect('edited', self.on_i_edited)
         column = Gtk.TreeViewColumn("I                              ", renderer, text=2)
+        column.set_cell_data_func(renderer, widgets.mark_unverified_cell, (pid, 'I%d'))
         self.append_column(column)
 
         reg = pld.registers['d1']
@@ -55,6 +58,7 @@ class PID(Gtk.TreeView):
         renderer.set_property("adjustment", adj)
         renderer.connect('edited', self.on_d_edited)
         column = Gtk.TreeViewColumn("d                              ", renderer, text=3)
+        column.set_cell_data_func(renderer, widgets.mark_unverified_cell, (pid, 'd%d'))
         self.append_column(column)
 
         for i in range(1,10):
@@ -69,6 +73,7 @@ class PID(Gtk.TreeView):
         self.popup.append(item)
 
         pid.connect('changed', self.changed)
+        pid.connect('verified', lambda pid, n, ok: self.queue_draw())
         self.connect('button-release-event', self.on_button)
 
     def on_p_edited(self, widget, path, text):
@@ -157,11 +162,8 @@ class PID(Gtk.TreeView):
 
     @twisted.internet.defer.inlineCallbacks
     def _refresh(self):
-        for row in range(1,10):
-            self.set_cursor(str(row-1), None)
-            for col in "PId":
-                d = self.pid.holding_read(col + str(row))
-                d.addErrback(lambda x: None)
-        yield self.pid.process_queue()
+        regs = [ col + str(row) for row in range(1,10) for col in "PId" ]
+        values = yield self.pid.block_read(regs)
+        self.pid.replay(values)
         self.set_cursor("0", None)
 
@@ -13,16 +13,24 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
 # Lesser General Public License for more details.
 
-import pymodbus.client.sync
 import pymodbus.factory
 import pymodbus.client.async
 import pymodbus.transaction
+import pymodbus.pdu
+import pymodbus.exceptions
+import pymodbus.utilities
+
+import json
+import os
+import random
+import time
+import traceback
 
 import twisted.internet.reactor
 import twisted.internet.serialport
+import twisted.internet.task
 import twisted.internet.protocol
-
-from gi.repository import GObject
+import twisted.python.failure
 
 inty = [ 'T Tc', 'R Tc', 'J Tc', 'Wre3-Wre5', 'B Tc', 'S Tc', 'K Tc', 'E Tc', 'Pt100',
          'Cu50', '0-375Ω', '0-80mV', '0-30mV', '0-5V', '1-5V', '0-10V', '0-10mA', '0-20mA', '4-20mA' ]
@@ -222,144 +230,1061 @@ bit_desc = {'SV':       'User modifying SV',
             'AL1':      'Alarm 1 active',
             'AT':       'Auto-tune active'}
 
-class Set64rs(pymodbus.client.async.ModbusClientProtocol, GObject.GObject):
+# Each register reads back as a (value, decimal point) word pair, so a run of
+# n registers at consecutive addresses can be fetched with one 2*n word read.
+# 60 registers keeps the response under the 125 word Modbus limit.
+max_block = 60
+
+class Register(object):
+    """Compiled form of a registers entry, with the decoder and encoder
+    for its kind of range picked once at import."""
+    __slots__ = [ 'name', 'desc', 'addr', 'range', 'default', 'mult', 'exact', 'spans', 'decode', 'encode' ]
+
+    def __init__(self, name, entry):
+        self.name = name
+        self.desc, self.addr, self.range, self.default, self.mult = entry
+        self.exact = {}
+        self.spans = []
+        if name == 'Pr+t':
+            self.decode = self.decode_step
+            self.encode = lambda value: None
+        elif type(self.range) is tuple:
+            self.decode = self.decode_span
+            self.encode = self.encode_span
+        elif type(self.range) is list:
+            self.exact = dict((text, n) for n, text in enumerate(self.range) if text is not None)
+            self.decode = self.decode_list
+            self.encode = self.encode_list
+        else:
+            for key, item in self.range.iteritems():
+                if type(item) is tuple:
+                    self.spans.append((item[0], item[1], key))
+                else:
+                    self.exact[item] = key
+            self.decode = self.decode_dict
+            self.encode = self.encode_dict
+
+    def decode_step(self, words):
+        Pr = words[0]>>8
+        t = ((words[0] & 0xff)<<8) + (words[1]>>8)
+        return (Pr, t), 1.0
+
+    def decode_span(self, words):
+        value, mult = scaled(words)
+        if self.range[0] <= value <= self.range[1]:
+            return value, mult
+        return None, mult
+
+    def decode_list(self, words):
+        value, mult = scaled(words)
+        try:
+            return self.range[value], mult
+        except:
+            return None, mult
+
+    def decode_dict(self, words):
+        value, mult = scaled(words)
+        if value in self.exact:
+            return self.exact[value], mult
+        for lo, hi, key in self.spans:
+            if lo <= value <= hi:
+                return (key, value), mult
+        return None, mult
+
+    def encode_span(self, value):
+        try:
+            if self.range[0] <= float(value) <= self.range[1]:
+                return float(value)
+        except:
+            pass
+        return None
+
+    def encode_list(self, value):
+        return self.exact.get(value)
+
+    def encode_dict(self, value):
+        try:
+            if type(value) is tuple:
+                value, idx = value
+            item = self.range[value]
+            if type(item) is tuple:
+                if item[0] <= float(idx) <= item[1]:
+                    return float(idx)
+            else:
+                return item
+        except:
+            pass
+        return None
+
+def scaled(words):
+    value = words[0]
+    value = value - 0x10000 if value > 0x7fff else value
+    mult = 10**-words[1]
+    return value * mult, mult
+
+codecs = dict((name, Register(name, entry)) for name, entry in registers.iteritems())
+by_address = dict((r.addr, r) for r in codecs.itervalues())
+
+def plan_reads(names, size=max_block):
+    blocks = []
+    for addr, n in sorted((codecs[n].addr, n) for n in set(names)):
+        if blocks and blocks[-1][0] + len(blocks[-1][1]) == addr and len(blocks[-1][1]) < size:
+            blocks[-1][1].append(n)
+        else:
+            blocks.append((addr, [n]))
+    return blocks
+
+def decode(reg, words):
+    if type(reg) is int:
+        if reg not in by_address:
+            value, mult = scaled(words)
+            return '0x%04x' % reg, value, mult
+        reg = by_address[reg].name
+    val, mult = codecs[reg].decode(words)
+    return reg, val, mult
+
+# Registers that change the decimal point of other registers.
+scale_deps = [ 'dot', 'Inty' ]
+
+def encode(reg, value):
+    return codecs[reg].encode(value)
+
+# Live values and commands, not part of a controller's configuration.
+volatile = [ 'PV', 'dSV', 'OUT', 'Pr+t', 'At' ]
+# Changing these drops the link, so they are restored last and only on request.
+comm_regs = [ 'Id', 'bAud' ]
+snapshot_version = 1
+
+def save_snapshot(f, image, unit_id=None):
+    json.dump({ 'format': 'set64rs', 'version': snapshot_version, 'unit': unit_id,
+                'time': time.time(), 'registers': image }, f, indent=1, sort_keys=True)
+
+def native(v):
+    """Undoes what JSON does to register values."""
+    if type(v) is unicode:
+        return v.encode('utf-8')
+    elif type(v) is list:
+        return tuple(native(i) for i in v)
+    return v
+
+def load_snapshot(f):
+    data = json.load(f)
+    if data.get('format') != 'set64rs' or data.get('version') != snapshot_version:
+        raise Exception('unsupported snapshot')
+    return dict((str(n), native(v)) for n, v in data['registers'].iteritems())
+
+# Last known values of each controller, kept between sessions.
+cache_dir = os.path.expanduser('~/.set64rs/cache')
 
-    __gsignals__ = {
-        'changed': (GObject.SIGNAL_RUN_FIRST, None, (str,object,float,)),
-    }
+def save_cache(path, values, unit_id=None):
+    """Writes a dict of name -> (val, mult) to path, replacing it in one
+    step so a crash can't leave half a file."""
+    d = os.path.dirname(path)
+    if d and not os.path.isdir(d):
+        os.makedirs(d)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({ 'format': 'set64rs-cache', 'version': snapshot_version, 'unit': unit_id,
+                    'time': time.time(), 'registers': values }, f, indent=1, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+def load_cache(path):
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('format') != 'set64rs-cache' or data.get('version') != snapshot_version:
+        raise Exception('unsupported cache')
+    return dict((str(n), (native(val), mult)) for n, (val, mult) in data['registers'].iteritems()
+                if str(n) in codecs)
+
+def to_word(val, mult):
+    val /= mult
+    if val < 0:
+        val += 0x10000
+    return int(val+1e-6)
+
+# Timeouts used until a unit has answered a few requests of that kind.
+initial_timeouts = { 1: 0.5, 3: 0.8, 5: 0.5, 16: 0.8 }
+
+def frame_bytes(fc, args):
+    """Request and response length on the wire in bytes."""
+    if fc == 1:
+        return 8, 5 + (args[1] + 7) // 8
+    elif fc == 3:
+        return 8, 5 + 2 * args[1]
+    elif fc == 16:
+        return 9 + 2 * len(args[1]), 8
+    return 8, 8
+
+class RttEstimator(object):
+    """Smoothed round trip time and variance, as used for the TCP
+    retransmission timer (RFC 6298), applied to device turnaround time."""
+    def __init__(self, initial, floor, ceiling):
+        self.srtt = None
+        self.rttvar = None
+        self.floor = floor
+        self.ceiling = ceiling
+        self.initial = initial
+        self.rto = initial
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.floor), self.ceiling)
+
+    def backoff(self):
+        # A unit that has never answered is most likely absent, waiting
+        # longer for it only holds up the others.
+        if self.srtt is None:
+            return
+        self.rto = min(self.rto * 2, self.ceiling)
+
+# Transaction priorities, lower numbers go on the wire first.
+WRITE, READ, POLL, BULK = range(4)
+
+
+class RetryPolicy(object):
+    """How transactions that time out are retried. Reads are tried up to
+    attempts times with exponential backoff and jitter. Retries draw on a
+    budget that successes refill, so a dead link doesn't multiply the
+    traffic. The bus is reset only after reset_after timeouts in a row
+    from one unit, more than one request's worth of attempts."""
+    def __init__(self, attempts=3, base=0.05, factor=2.0, cap=1.0, jitter=0.5,
+                 budget=10, refill=0.1, reset_after=6):
+        self.attempts = attempts
+        self.base = base
+        self.factor = factor
+        self.cap = cap
+        self.jitter = jitter
+        self.budget = budget
+        self.refill = refill
+        self.reset_after = reset_after
+        self.tokens = float(budget)
+
+    def delay(self, retry):
+        delay = min(self.cap, self.base * self.factor ** (retry - 1))
+        return random.uniform(delay * (1 - self.jitter), delay)
+
+    def allow(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def success(self):
+        self.tokens = min(self.budget, self.tokens + self.refill)
+
+class QueueFull(Exception):
+    """Raised when a request is dropped because the bus queue is full"""
+
+class Transaction(object):
+    __slots__ = [ 'unit', 'priority', 'func', 'args', 'queued', 'seq', 'd', 'key', 'waiters',
+                  'resume' ]
+
+    def __init__(self, unit, priority, func, args, key=None):
+        self.unit = unit
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.queued = twisted.internet.reactor.seconds()
+        self.key = key
+        self.d = None
+        # Deferreds of requests merged into this one.
+        self.waiters = []
+        # (transaction, Deferred) for a place in the queue taken by a
+        # transaction coming back from a backoff.
+        self.resume = None
+
+class BusStats(object):
+    """Counters for everything that happens on a Bus."""
 
     def __init__(self):
-        GObject.GObject.__init__(self)
-        framer = pymodbus.transaction.ModbusRtuFramer(pymodbus.factory.ClientDecoder())
+        self.started = twisted.internet.reactor.seconds()
+        self.transactions = 0
+        self.timeouts = 0
+        self.resets = 0
+        self.crc_errors = 0
+        # Received bytes that weren't part of a good frame.
+        self.discarded = 0
+        self.bytes = 0
+        self.wire_time = 0.0
+        self.queued = 0
+        self.queue_wait = 0.0
+        self.queue_wait_max = 0.0
+        self.queue_max = 0
+        self.coalesced = 0
+        # key -> [transactions, timeouts, total seconds]
+        self.fc = {}
+        self.unit = {}
+        self.register = {}
+
+    def transaction(self, unit, fc, args, start, end, ok, char_time):
+        req, resp = frame_bytes(fc, args)
+        n = req + resp if ok else req
+        self.transactions += 1
+        self.timeouts += not ok
+        self.bytes += n
+        self.wire_time += n * char_time
+        if fc in (1, 5):
+            reg = 'coil %d' % args[0]
+        else:
+            reg = by_address[args[0]].name if args[0] in by_address else '0x%04x' % args[0]
+        for table, key in [ (self.fc, fc), (self.unit, unit), (self.register, reg) ]:
+            c = table.setdefault(key, [0, 0, 0.0])
+            c[0] += 1
+            c[1] += not ok
+            c[2] += end - start
+
+    def waited(self, wait):
+        self.queued += 1
+        self.queue_wait += wait
+        self.queue_wait_max = max(self.queue_wait_max, wait)
+
+    def report(self, depth=0):
+        now = twisted.internet.reactor.seconds()
+        elapsed = max(now - self.started, 1e-6)
+        def table(t):
+            return dict((k, { 'count': c[0], 'timeouts': c[1], 'mean': c[2] / c[0] })
+                        for k, c in t.iteritems())
+        return {
+            'elapsed': elapsed,
+            'transactions': self.transactions,
+            'tps': self.transactions / elapsed,
+            'timeouts': self.timeouts,
+            'resets': self.resets,
+            'crc_errors': self.crc_errors,
+            'discarded': self.discarded,
+            'bytes': self.bytes,
+            'wire_time': self.wire_time,
+            'utilization': 100.0 * self.wire_time / elapsed,
+            'queue_depth': depth,
+            'queue_max': self.queue_max,
+            'coalesced': self.coalesced,
+            'queue_wait': self.queue_wait / self.queued if self.queued else 0.0,
+            'queue_wait_max': self.queue_wait_max,
+            'fc': table(self.fc),
+            'unit': table(self.unit),
+            'register': table(self.register),
+        }
+
+class Framer(pymodbus.transaction.ModbusRtuFramer):
+    """RTU framer that resynchronises after noise. Instead of losing the
+    whole buffer to a bad frame, it looks for the next offset holding a
+    frame with a good CRC from the unit and function it is waiting on, and
+    drops only the bytes in front of it."""
+
+    min_frame = 4
+    max_frame = 256
+
+    def __init__(self, decoder, stats):
+        pymodbus.transaction.ModbusRtuFramer.__init__(self, decoder)
+        self.stats = stats
+        self.buffer = ''
+        # (unit, fc) of the response being waited for, None takes any.
+        self.expected = None
+        # RTU frames carry no transaction id, replies are given the id of
+        # the one request outstanding so the protocol can match them.
+        self.tid = None
+
+    def expect(self, unit, fc):
+        """Called as a request goes out, nothing already received can be
+        its response."""
+        self.clear()
+        self.expected = (unit, fc)
+        self.tid = None
+
+    def clear(self):
+        self.stats.discarded += len(self.buffer)
+        self.buffer = ''
+
+    def frame_size(self, offset):
+        """Returns the size of the frame that would start at offset, 0 if
+        none can, or None if more bytes are needed to tell."""
+        unit, fc = ord(self.buffer[offset]), ord(self.buffer[offset + 1])
+        if self.expected is not None and \
+                (unit != self.expected[0] or fc & 0x7f != self.expected[1]):
+            return 0
+        try:
+            size = self.decoder.lookupPduClass(fc).calculateRtuFrameSize(self.buffer[offset:])
+        except IndexError:
+            return None
+        if size < self.min_frame or size > self.max_frame:
+            return 0
+        if offset + size > len(self.buffer):
+            return None
+        return size
+
+    def check(self, offset, size):
+        crc = self.buffer[offset + size - 2:offset + size]
+        return pymodbus.utilities.checkCRC(self.buffer[offset:offset + size - 2],
+                                           (ord(crc[0]) << 8) + ord(crc[1]))
+
+    def processIncomingPacket(self, data, callback):
+        self.buffer += data
+        offset = 0
+        # First offset that may still turn out to start a frame.
+        partial = None
+        bad = []
+        while offset + self.min_frame <= len(self.buffer):
+            size = self.frame_size(offset)
+            if size is None:
+                if partial is None:
+                    partial = offset
+            elif size and self.check(offset, size):
+                frame = self.buffer[offset:offset + size]
+                self.stats.discarded += offset
+                self.stats.crc_errors += len(bad)
+                self.buffer = self.buffer[offset + size:]
+                offset = 0
+                partial = None
+                bad = []
+                result = self.decoder.decode(frame[1:-2])
+                if result is None:
+                    raise pymodbus.exceptions.ModbusIOException("Unable to decode response")
+                result.unit_id = ord(frame[0])
+                if self.tid is not None:
+                    result.transaction_id = self.tid
+                callback(result)
+                continue
+            elif size:
+                bad.append(offset)
+            offset += 1
+        if partial is not None:
+            offset = partial
+        self.stats.discarded += offset
+        self.stats.crc_errors += len([ b for b in bad if b < offset ])
+        self.buffer = self.buffer[offset:]
+
+class Bus(pymodbus.client.async.ModbusClientProtocol):
+    """Owns the RTU link and the transaction queue shared by every
+    controller on the segment, see Set64rs for the per-unit API."""
+
+    def __init__(self):
+        self.stats = BusStats()
+        framer = Framer(pymodbus.factory.ClientDecoder(), self.stats)
         pymodbus.client.async.ModbusClientProtocol.__init__(self, framer)
-        self.unit_id = 5
-        self.reg_iter = registers.iteritems()
-        self.queue = list()
-        self.last = None
+        self.units = {}
+        self.pending = []
+        self.served = {}
+        self.seq = 0
+        self.max_queue = 256
+        self.aging = 2.0
+        self.active = None
+        # The transaction on the bus, and those waiting out a backoff.
+        self.current = None
+        self.suspended = []
+        self.idle = {}
+        self.baudrate = 9600
+        # Minimum silent time between frames in seconds, None derives it
+        # from the baud rate. Raise it for devices that need longer.
+        self.frame_gap = None
+        self.last_frame = 0
+        # Bounds on the timeout beyond the time spent on the wire.
+        self.timeout_floor = 0.05
+        self.timeout_ceiling = 0.8
+        self.rtt = {}
+        # Called as tracer(unit, fc, args, start, end, ok) after every
+        # transaction on the wire.
+        self.tracer = None
+        # Seconds between 'stats' signals on each unit, None for none.
+        self.stats_interval = 1.0
+        self.stats_call = twisted.internet.task.LoopingCall(self.emit_stats)
+        self.last_report = None
+        self.retry = RetryPolicy()
+        # unit -> timeouts in a row
+        self.failures = {}
+
+    def unit(self, unit_id):
+        if unit_id not in self.units:
+            self.units[unit_id] = Set64rs(self, unit_id)
+            if self.stats_interval and not self.stats_call.running:
+                self.stats_call.start(self.stats_interval, now=False)
+        return self.units[unit_id]
+
+    def statistics(self):
+        return self.stats.report(len(self.pending))
+
+    def emit_stats(self):
+        report = self.statistics()
+        # Rates over the last interval as well as since the start.
+        last = self.last_report or { 'elapsed': 0.0, 'transactions': 0, 'wire_time': 0.0 }
+        dt = max(report['elapsed'] - last['elapsed'], 1e-6)
+        report['recent'] = {
+            'tps': (report['transactions'] - last['transactions']) / dt,
+            'utilization': 100.0 * (report['wire_time'] - last['wire_time']) / dt,
+        }
+        self.last_report = report
+        for unit in self.units.values():
+            unit.emit('stats', report)
+
+    def inter_frame_gap(self):
+        if self.frame_gap is not None:
+            return self.frame_gap
+        # 3.5 character times of 11 bits, fixed at 1.75ms above 19200 baud.
+        if self.baudrate > 19200:
+            return 0.00175
+        return 3.5 * self.char_time()
+
+    def connectionMade(self):
+        pymodbus.client.async.ModbusClientProtocol.connectionMade(self)
+        self._pump()
+
+    def execute(self, request):
+        d = pymodbus.client.async.ModbusClientProtocol.execute(self, request)
+        self.framer.tid = request.transaction_id
+        return d
+
+    def dataReceived(self, data):
+        self.last_frame = twisted.internet.reactor.seconds()
+        pymodbus.client.async.ModbusClientProtocol.dataReceived(self, data)
+
+    def char_time(self):
+        return 11 / float(self.baudrate)
+
+    def estimator(self, unit, fc):
+        key = (unit, fc)
+        if key not in self.rtt:
+            initial = min(max(initial_timeouts.get(fc, 0.8), self.timeout_floor), self.timeout_ceiling)
+            self.rtt[key] = RttEstimator(initial, self.timeout_floor, self.timeout_ceiling)
+        return self.rtt[key]
+
+    def rtt_estimates(self):
+        ret = {}
+        for key, e in self.rtt.iteritems():
+            ret[key] = { 'srtt': e.srtt, 'rttvar': e.rttvar, 'timeout': e.rto }
+        return ret
+
+    def abandon(self):
+        # Forget requests given up on, so a late reply can't be taken as
+        # the answer to the next one.
+        for tid, d in self._requests.items():
+            if d.called:
+                del self._requests[tid]
+
+    def reset(self, err):
+        self.stats.resets += 1
+        self.connectionLost('transaction error')
+        self.abandon()
+        self.framer.clear()
+        self.connectionMade()
+        if err is not None:
+            print 'error', err
+
+    @twisted.internet.defer.inlineCallbacks
+    def send(self, fc, func, *args, **kwargs):
+        gap = self.last_frame + self.inter_frame_gap() - twisted.internet.reactor.seconds()
+        if gap > 0:
+            d = twisted.internet.defer.Deferred()
+            twisted.internet.reactor.callLater(gap, d.callback, None)
+            yield d
+
+        # Only the turnaround is estimated, the wire time depends on the
+        # length of the frames and is added back here.
+        est = self.estimator(kwargs.get('unit'), fc)
+        wire = sum(frame_bytes(fc, args)) * self.char_time()
+        start = twisted.internet.reactor.seconds()
+        ok = False
+        self.framer.expect(kwargs.get('unit', 0), fc)
+        try:
+            response = yield timeout(est.rto + wire)(func)(*args, **kwargs)
+            ok = True
+        except TimeoutError:
+            est.backoff()
+            self.abandon()
+            raise
+        finally:
+            self.last_frame = twisted.internet.reactor.seconds()
+            self.stats.transaction(kwargs.get('unit'), fc, args, start, self.last_frame, ok, self.char_time())
+            if self.tracer is not None:
+                self.tracer(kwargs.get('unit'), fc, args, start, self.last_frame, ok)
+        est.sample(max(self.last_frame - start - wire, 0))
+        twisted.internet.defer.returnValue(response)
+
+    @twisted.internet.defer.inlineCallbacks
+    def transact(self, fc, func, *args, **kwargs):
+        """send() once, resetting the link after repeated timeouts."""
+        unit = kwargs.get('unit')
+        try:
+            response = yield self.send(fc, func, *args, **kwargs)
+        except TimeoutError:
+            self.failures[unit] = self.failures.get(unit, 0) + 1
+            if self.failures[unit] >= self.retry.reset_after:
+                self.failures.clear()
+                self.reset('%d timeouts in a row from unit %s' % (self.retry.reset_after, unit))
+            raise
+        self.failures.pop(unit, None)
+        self.retry.success()
+        twisted.internet.defer.returnValue(response)
+
+    def backoff(self, retry):
+        """Waits before a retry, letting other transactions have the bus
+        meanwhile. Fires once the calling transaction has it back."""
+        d = twisted.internet.defer.Deferred()
+        t = self.current
+        if t is None:
+            twisted.internet.reactor.callLater(self.retry.delay(retry), d.callback, None)
+            return d
+        self.current = None
+        self.active = None
+        self.suspended.append(t)
+        twisted.internet.reactor.callLater(self.retry.delay(retry), self._resume, t, d)
+        self._pump()
+        return d
+
+    def _resume(self, t, d):
+        # Back in the queue, in its old place and with its age.
+        self.suspended.remove(t)
+        r = Transaction(t.unit, t.priority, None, ())
+        r.queued = t.queued
+        r.seq = t.seq
+        r.resume = (t, d)
+        self.pending.append(r)
+        self._pump()
+
+    @twisted.internet.defer.inlineCallbacks
+    def read(self, fc, func, *args, **kwargs):
+        """transact() for requests that are safe to repeat. A unit that
+        has never answered is taken to be absent and not retried."""
+        retry = 0
+        while True:
+            try:
+                response = yield self.transact(fc, func, *args, **kwargs)
+                twisted.internet.defer.returnValue(response)
+            except TimeoutError:
+                retry += 1
+                if retry >= self.retry.attempts or \
+                        self.estimator(kwargs.get('unit'), fc).srtt is None or \
+                        not self.retry.allow():
+                    raise
+            yield self.backoff(retry)
+
+    @twisted.internet.defer.inlineCallbacks
+    def write(self, addr, words, unit):
+        """Write holding registers. A write that times out may still have
+        been applied, so it is only sent again if reading the registers
+        back shows it wasn't."""
+        retry = 0
+        while True:
+            try:
+                response = yield self.transact(16, self.write_registers, addr, words, unit=unit)
+                twisted.internet.defer.returnValue(response)
+            except TimeoutError:
+                retry += 1
+                if retry >= self.retry.attempts or not self.retry.allow():
+                    raise
+            yield self.backoff(retry)
+            check = yield self.read(3, self.read_holding_registers, addr, len(words), unit=unit)
+            # Only the values, the device reports its own decimal point.
+            if getattr(check, 'registers', None) is not None and \
+                    check.registers[0::2] == words[0::2]:
+                twisted.internet.defer.returnValue(None)
+
+    def submit(self, unit, priority, func, *args):
+        return self.enqueue(Transaction(unit, priority, func, args))
+
+    def coalesce(self, unit, priority, key, func, *args):
+        """submit() for writes. A queued write with the same key is
+        replaced by this one instead of adding another. Every caller gets
+        the result of the last one."""
+        for t in self.pending:
+            if t.unit == unit and t.key == key:
+                # It takes the new request's place in the queue, so it
+                # still follows anything queued in between, like a change
+                # of the decimal point it is encoded with.
+                t.func = func
+                t.args = args
+                t.priority = priority
+                t.queued = twisted.internet.reactor.seconds()
+                t.seq = self.seq
+                self.seq += 1
+                return self._wait(t)
+        return self.enqueue(Transaction(unit, priority, func, args, key))
+
+    def share(self, unit, priority, key, func, *args):
+        """submit() for reads. A read with the same key as one queued, on
+        the bus or waiting out a backoff gets that one's result instead of
+        being sent again. A queued one moves up to the more urgent
+        priority."""
+        for t in [ self.current ] + self.suspended + self.pending:
+            if t is not None and t.unit == unit and t.key == key:
+                if t in self.pending:
+                    t.priority = min(t.priority, priority)
+                return self._wait(t)
+        return self.enqueue(Transaction(unit, priority, func, args, key))
+
+    def _wait(self, t):
+        self.stats.coalesced += 1
+        d = twisted.internet.defer.Deferred(t.waiters.remove)
+        t.waiters.append(d)
+        return d
+
+    def enqueue(self, t):
+        t.d = twisted.internet.defer.Deferred(self._cancel)
+        if len(self.pending) >= self.max_queue:
+            # Make room by dropping the least urgent request, unless the
+            # new one is the least urgent.
+            now = twisted.internet.reactor.seconds()
+            worst = max([ p for p in self.pending if p.resume is None ],
+                        key=lambda p: (self.effective(p, now), p.seq))
+            if self.effective(worst, now) <= t.priority:
+                return twisted.internet.defer.fail(QueueFull('queue full'))
+            self.pending.remove(worst)
+            for d in [ worst.d ] + worst.waiters:
+                d.errback(QueueFull('queue full'))
+        t.seq = self.seq
+        self.seq += 1
+        self.pending.append(t)
+        self.stats.queue_max = max(self.stats.queue_max, len(self.pending))
+        self._pump()
+        return t.d
+
+    def effective(self, t, now):
+        # Waiting requests move up one class for every aging seconds.
+        return t.priority - int((now - t.queued) / self.aging)
+
+    def _cancel(self, d):
+        for t in self.pending:
+            # Still wanted by the callers merged into it.
+            if t.d is d and not t.waiters:
+                self.pending.remove(t)
+                break
+
+    def _pump(self):
+        if self.active is not None or not self.pending or not self._connected:
+            return
+        # Within a class, units are served round robin so one unit's bulk
+        # refresh can't hold up the others.
+        now = twisted.internet.reactor.seconds()
+        t = min(self.pending, key=lambda p: (self.effective(p, now), self.served.get(p.unit, -1), p.seq))
+        self.pending.remove(t)
+        self.stats.waited(now - t.queued)
+        self.served[t.unit] = self.seq
+        self.seq += 1
+        self.active = t.unit
+        if t.resume is not None:
+            self.current, d = t.resume
+            d.callback(None)
+            return
+        self.current = t
+        r = twisted.internet.defer.maybeDeferred(t.func, *t.args)
+        r.addBoth(self._done, t)
+
+    def _done(self, result, t):
+        if self.current is t:
+            self.current = None
+            self.active = None
+        self._pump()
+        # A request cancelled while on the wire has already failed.
+        for d in [ t.d ] + t.waiters:
+            if d.called:
+                continue
+            if isinstance(result, twisted.python.failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        for key in [ t.unit, None ]:
+            if not self.busy(key):
+                for waiter in self.idle.pop(key, []):
+                    waiter.callback(None)
+
+    def busy(self, unit=None):
+        if unit is None:
+            return self.active is not None or bool(self.pending) or bool(self.suspended)
+        return self.active == unit or any(t.unit == unit for t in self.pending + self.suspended)
+
+    def process_queue(self, unit=None):
+        if not self.busy(unit):
+            return twisted.internet.defer.succeed(None)
+        d = twisted.internet.defer.Deferred()
+        self.idle.setdefault(unit, []).append(d)
+        return d
+
+class TcpFramer(pymodbus.transaction.ModbusSocketFramer):
+    """Modbus TCP framer with the hooks Bus uses. TCP frames carry their
+    transaction id and arrive intact, there is nothing to resynchronise."""
+
+    def __init__(self, decoder, stats):
+        pymodbus.transaction.ModbusSocketFramer.__init__(self, decoder)
+        self.stats = stats
+        self.tid = None
+
+    def expect(self, unit, fc):
+        pass
+
+    def clear(self):
+        pass
+
+class GatewayBus(Bus):
+    """A Bus reached through gateway.py. The gateway answers every
+    request, with an exception if the device doesn't, and does its own
+    retries, so the timeout here only guards against losing the gateway
+    itself."""
+
+    def __init__(self):
+        Bus.__init__(self)
+        self.framer = TcpFramer(pymodbus.factory.ClientDecoder(), self.stats)
+        self.frame_gap = 0
+        self.timeout_floor = 5.0
+        self.timeout_ceiling = 10.0
+        self.retry.attempts = 1
+
+    @twisted.internet.defer.inlineCallbacks
+    def send(self, fc, func, *args, **kwargs):
+        response = yield Bus.send(self, fc, func, *args, **kwargs)
+        # Gateway target device failed to respond.
+        if isinstance(response, pymodbus.pdu.ExceptionResponse) and \
+                response.exception_code == 0x0b:
+            raise TimeoutError('unit %s did not answer the gateway' % kwargs.get('unit'))
+        twisted.internet.defer.returnValue(response)
+
+    def char_time(self):
+        # No serial line on this side, the gateway's own stats cover it.
+        return 0
+
+class GatewayFactory(twisted.internet.protocol.ReconnectingClientFactory):
+    maxDelay = 10
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return self.bus
+
+class Subscription(object):
+    __slots__ = [ 'reg', 'interval', 'callback', 'due' ]
+
+    def __init__(self, reg, interval, callback):
+        self.reg = reg
+        self.interval = interval
+        self.callback = callback
+        self.due = twisted.internet.reactor.seconds()
+
+class Signals(object):
+    """The connect, disconnect and emit of GObject signals, so the
+    command line tools don't need GObject. Handlers are called as
+    handler(obj, *args + data), and an exception in one is printed
+    without stopping the others."""
+
+    signals = []
+
+    def __init__(self):
+        self.handlers = []
+        self.next_handler = 1
+
+    def connect(self, name, handler, *data):
+        if name not in self.signals:
+            raise TypeError('%s has no signal %s' % (type(self).__name__, name))
+        handler_id = self.next_handler
+        self.next_handler += 1
+        self.handlers.append((handler_id, name, handler, data))
+        return handler_id
+
+    def disconnect(self, handler_id):
+        self.handlers = [ h for h in self.handlers if h[0] != handler_id ]
+
+    def emit(self, name, *args):
+        for handler_id, n, handler, data in self.handlers[:]:
+            if n == name:
+                try:
+                    handler(self, *(args + data))
+                except Exception:
+                    traceback.print_exc()
+
+class Set64rs(Signals):
+
+    # changed(name, val, mult) when a read returns a new value,
+    # verified(name, verified) when a value loaded from the last session
+    # is shown and when it is read back from the device,
+    # stats(Bus.statistics()) every Bus.stats_interval seconds.
+    signals = [ 'changed', 'verified', 'stats' ]
+
+    def __init__(self, bus, unit_id=5):
+        Signals.__init__(self)
+        self.bus = bus
+        self.unit_id = unit_id
+        self.max_block = max_block
+        # Decimal point scale of each register as last read, so writes
+        # don't need a read first. Depends on dot and Inty.
+        self.scales = {}
+        self.scale_deps = {}
+        # Shared poller, register name or 'flags' -> [Subscription]
+        self.subs = {}
+        self.poll_call = None
+        self.polling = False
+        # Last value read of each register, name -> (val, mult, time).
+        # Reads within the register's ttl are answered from here, older
+        # values are answered from here too while a fresh read is queued.
+        self.values = {}
+        self.live_ttl = 0.25
+        self.config_ttl = 60.0
+        # Registers loaded from the last session, not yet read back.
+        self.unverified = set()
+        # Registers with a background read of a stale value queued.
+        self.revalidating = set()
+        self.cache_path = None
+        self.save_delay = 5.0
+        self.save_call = None
+
+    def ttl(self, reg):
+        if reg == 'flags' or reg in volatile:
+            return self.live_ttl
+        return self.config_ttl
+
+    def _seen(self, reg, val, mult, suppress):
+        # Suppressed reads aren't shown, so they can't update what
+        # 'changed' compares against.
+        if suppress:
+            return
+        old = self.values.get(reg)
+        self.values[reg] = (val, mult, twisted.internet.reactor.seconds())
+        if reg in self.unverified:
+            self.unverified.discard(reg)
+            self.emit('verified', reg, True)
+        if old is None or old[:2] != (val, mult):
+            self.emit('changed', reg, val, mult)
+            if self.cache_path and reg in codecs and reg not in volatile and \
+                    not (self.save_call and self.save_call.active()):
+                self.save_call = twisted.internet.reactor.callLater(self.save_delay, self.save)
+
+    def _cached(self, reg):
+        """Returns (val, mult, stale) for reg, or None if never read."""
+        if reg not in self.values:
+            return None
+        val, mult, t = self.values[reg]
+        return val, mult, twisted.internet.reactor.seconds() - t >= self.ttl(reg)
+
+    def _revalidate(self, names, read, *args):
+        names = [ n for n in names if n not in self.revalidating ]
+        if not names:
+            return
+        self.revalidating.update(names)
+        d = read(names, *args)
+        d.addErrback(lambda x: None)
+        d.addCallback(lambda x: self.revalidating.difference_update(names))
+
+    def persist(self, path=None):
+        """Keep the configuration values of this controller in path, by
+        default in cache_dir. Values saved by the last session are shown
+        straight away as unverified, and read back in the background."""
+        self.cache_path = path or os.path.join(cache_dir, '%d.json' % self.unit_id)
+        twisted.internet.reactor.addSystemEventTrigger('before', 'shutdown', self.save)
+        try:
+            saved = load_cache(self.cache_path)
+        except IOError:
+            saved = {}
+        except Exception, e:
+            print 'ignoring %s: %s' % (self.cache_path, e)
+            saved = {}
+        for n, (val, mult) in saved.iteritems():
+            if n not in self.values:
+                # As old as can be, so the next read goes to the device.
+                self.values[n] = (val, mult, 0)
+                self.unverified.add(n)
+                self.emit('changed', n, val, mult)
+                self.emit('verified', n, False)
+        self._revalidate(list(self.unverified), self.block_read, False, BULK, True)
+
+    def save(self):
+        if self.save_call and self.save_call.active():
+            self.save_call.cancel()
+        self.save_call = None
+        if self.cache_path is None:
+            return
+        values = dict((n, (val, mult)) for n, (val, mult, t) in self.values.iteritems()
+                      if n in codecs and n not in volatile)
+        try:
+            save_cache(self.cache_path, values, self.unit_id)
+        except (IOError, OSError), e:
+            print 'cannot save %s: %s' % (self.cache_path, e)
+
+    def replay(self, values):
+        """Emit changed for a dict of name -> (val, mult) returned by a
+        read, for views built after the values were first seen."""
+        for n, (val, mult) in values.iteritems():
+            self.emit('changed', n, val, mult)
 
     @twisted.internet.defer.inlineCallbacks
     def _flags(self):
         try:
-            response = yield timeout(0.5)(self.read_coils)(0, 8, unit=self.unit_id)
+            response = yield self.bus.read(1, self.bus.read_coils, 0, 8, unit=self.unit_id)
             val = dict(zip(bits, response.bits))
-            self.emit('changed', 'flags', val, 1.0)
+            self._seen('flags', val, 1.0, False)
         except TimeoutError, e:
             val = None
-        finally:
-            d = twisted.internet.defer.Deferred()
-            twisted.internet.reactor.callLater(0.01, d.callback, None)
-            yield d
         twisted.internet.defer.returnValue(val)
 
-    def reset(self, err):
-        self.connectionLost('transaction error')
-        self.framer._ModbusRtuFramer__buffer = ''
-        self.framer._ModbusRtuFramer__header = {}
-        self.connectionMade()
-        if err is not None:
-            print 'error', err
-
     @twisted.internet.defer.inlineCallbacks
     def _holding_read(self, reg, suppress=False):
         if type(reg) is int:
-            register = None
             addr = reg
         else:
-            register = registers[reg]
-            addr = register[1]
-        try:
-            response = yield timeout(0.8)(self.read_holding_registers)(addr, 2, unit=self.unit_id)
-        except TimeoutError, e:
-            self.reset('timeout ' + str(reg))
-            raise e
-
-        mult = 1.0
-        if reg == 'Pr+t':
-            Pr = response.registers[0]>>8
-            t = ((response.registers[0] & 0xff)<<8) + (response.registers[1]>>8)
-            val = (Pr, t)
-        else:
-            value = response.registers[0]
-            value = value - 0x10000 if value > 0x7fff else value
-            mult = 10**-response.registers[1]
-            value *= mult
-            if register is None:
-                val = value
-                reg = '0x%04x' % reg
-            else:
-                val = None
-                if type(register[2]) is tuple:
-                    if value >= register[2][0] and value <= register[2][1]:
-                        val = value
-                    else:
-                        pass
-                elif type(register[2]) is list:
-                    try:
-                        val = register[2][value]
-                    except:
-                        pass
-                elif type(register[2]) is dict:
-                    for key, item in register[2].iteritems():
-                        if type(item) is tuple:
-                            if value >= item[0] and value <= item[1]:
-                                val = (key, value)
-                                break
-                        elif item == value:
-                            val = key
-                            break
-        if not suppress:
-            self.emit("changed", reg, val, mult)
-        d = twisted.internet.defer.Deferred()
-        twisted.internet.reactor.callLater(0.01, d.callback, None)
-        yield d
+            addr = codecs[reg].addr
+        response = yield self.bus.read(3, self.bus.read_holding_registers, addr, 2, unit=self.unit_id)
+
+        reg, val, mult = decode(reg, response.registers)
+        self._scale_seen(reg, val, mult)
+        self._seen(reg, val, mult, suppress)
         twisted.internet.defer.returnValue((val, mult))
 
     @twisted.internet.defer.inlineCallbacks
-    def _holding_write(self, reg, value):
-        register = registers[reg]
-        val = None
-        if type(register[2]) is tuple:
-            if register[2][0] <= float(value) <= register[2][1]:
-                val = float(value)
-        elif type(register[2]) is list:
-            try:
-                val = register[2].index(value)
-            except:
-                pass
-        elif type(register[2]) is dict:
-            try:
-                if type(value) is tuple:
-                    value, idx = value
-                item = register[2][value]
-                if type(item) is tuple:
-                    if item[0] <= float(idx) <= item[1]:
-                        val = float(idx)
-                else:
-                    val = item
-            except:
-                pass
+    def _block_read(self, names, suppress=False):
+        ret = {}
+        blocks = plan_reads(names, self.max_block)
+        while blocks:
+            addr, block = blocks.pop(0)
+            response = yield self.bus.read(3, self.bus.read_holding_registers, addr, 2*len(block), unit=self.unit_id)
+
+            if isinstance(response, pymodbus.pdu.ExceptionResponse):
+                # Device refused a read this long, learn the limit and split.
+                if len(block) == 1:
+                    raise Exception('read of %s refused' % block[0])
+                self.max_block = len(block) // 2
+                blocks[0:0] = plan_reads(block, self.max_block)
+                continue
 
+            words = response.registers
+            for i, n in enumerate(block):
+                val, mult = codecs[n].decode(words[i*2:i*2+2])
+                self._scale_seen(n, val, mult)
+                ret[n] = (val, mult)
+                self._seen(n, val, mult, suppress)
+        twisted.internet.defer.returnValue(ret)
+
+    def _scale_seen(self, reg, val, mult):
+        if reg in scale_deps:
+            if self.scale_deps.get(reg, val) != val:
+                self.scales.clear()
+            self.scale_deps[reg] = val
+        if reg in registers and reg != 'Pr+t':
+            self.scales[reg] = mult
+
+    @twisted.internet.defer.inlineCallbacks
+    def _scale(self, reg):
+        if reg not in self.scales:
+            yield self._holding_read(reg, suppress=True)
+        twisted.internet.defer.returnValue(self.scales[reg])
+
+    @twisted.internet.defer.inlineCallbacks
+    def _holding_write(self, reg, value):
+        register = codecs[reg]
+        val = register.encode(value)
         if val is None:
             raise Exception('invalid argument')
         elif reg == 'OUT':
-            d = timeout(0.8)(self.write_registers)(register[1], [int(val*10.0+1), 1], unit=self.unit_id)
+            words = [int(val*10.0+1), 1]
         else:
-            d = self._holding_read(reg, suppress=True)
-            _, mult = yield d
-            val /= mult
-            if val < 0:
-                val += 0x10000
-            d = timeout(0.8)(self.write_registers)(register[1], [int(val+1e-6), 0], unit=self.unit_id)
+            mult = yield self._scale(reg)
+            words = [to_word(val, mult), 0]
 
-        try:
-            yield d
-        except TimeoutError, e:
-            self.reset('timeout ' + str(reg))
-            raise e
-
-        d = twisted.internet.defer.Deferred()
-        twisted.internet.reactor.callLater(0.01, d.callback, None)
-        yield d
+        yield self.bus.write(register.addr, words, self.unit_id)
+        self.values.pop(reg, None)
+        if reg in scale_deps:
+            self.scales.clear()
+            self.scale_deps.pop(reg, None)
+            self.values.clear()
 
     @twisted.internet.defer.inlineCallbacks
     def _coil(self, reg):
@@ -381,120 +1306,295 @@ class Set64rs(pymodbus.client.async.ModbusClientProtocol, GObject.GObject):
         else:
             raise Exception('Invalid parameter')
 
+        # Commands like pause toggle, so they are never repeated.
         try:
-            yield timeout(0.5)(self.write_coil)(v[0], v[1], unit=self.unit_id)
+            yield self.bus.transact(5, self.bus.write_coil, v[0], v[1], unit=self.unit_id)
         except TimeoutError, e:
-            self.reset(None)
+            pass
+        for n in volatile + [ 'flags' ]:
+            self.values.pop(n, None)
 
-        d = twisted.internet.defer.Deferred()
-        twisted.internet.reactor.callLater(0.01, d.callback, None)
-        yield d
+    @twisted.internet.defer.inlineCallbacks
+    def _write_program(self, steps, mode):
+        names = []
+        values = {}
+        for i, step in enumerate(steps):
+            for col, value in zip([ 'C-', 't-', 'Sv' ], step):
+                n = col + ('%02d' % (i+1))
+                val = encode(n, value)
+                if val is None:
+                    raise Exception('invalid argument %s: %r' % (n, value))
+                names.append(n)
+                values[n] = val
+        if not codecs['PrH'].range[0] <= len(steps) <= codecs['PrH'].range[1]:
+            raise Exception('invalid program length %d' % len(steps))
+        if mode not in codecs['ModL'].exact:
+            raise Exception('invalid mode %s' % mode)
+
+        yield self._holding_write('ModL', 'SV')
+        yield self._holding_write('PrL', 1)
+        yield self._holding_write('PrH', len(steps))
+
+        # C-xx and t-xx are plain integers, only the SV column is scaled.
+        mult = yield self._scale('Sv01')
+        mults = dict((n, mult if n[:2] == 'Sv' else 1.0) for n in names)
+        for addr, block in plan_reads(names, self.max_block):
+            words = []
+            for n in block:
+                words += [ to_word(values[n], mults[n]), 0 ]
+            yield self.bus.write(addr, words, self.unit_id)
+
+        result = yield self._block_read(names)
+        for n in names:
+            val = encode(n, result[n][0])
+            if val is None or to_word(val, mults[n]) != to_word(values[n], mults[n]):
+                raise Exception('verify failed at %s' % n)
+
+        yield self._coil('start')
+        yield self._holding_write('ModL', mode)
+
+    @twisted.internet.defer.inlineCallbacks
+    def _snapshot(self):
+        result = yield self._block_read([ n for n in codecs if n not in volatile ], suppress=True)
+        twisted.internet.defer.returnValue(dict((n, val) for n, (val, mult) in result.iteritems()))
+
+    def _differs(self, reg, value, current):
+        val, mult = current
+        cur = None if val is None else codecs[reg].encode(val)
+        return cur is None or to_word(cur, mult) != to_word(codecs[reg].encode(value), mult)
+
+    @twisted.internet.defer.inlineCallbacks
+    def _restore(self, image, comm):
+        names = [ n for n in image if n in codecs and n not in volatile and image[n] is not None ]
+        if not comm:
+            names = [ n for n in names if n not in comm_regs ]
+        for n in names:
+            if codecs[n].encode(image[n]) is None:
+                raise Exception('invalid argument %s: %r' % (n, image[n]))
+
+        # Units and decimal point first, they change the scale of the rest.
+        written = []
+        current = yield self._block_read(names, suppress=True)
+        for n in scale_deps + [ 'corf' ]:
+            if n in names and self._differs(n, image[n], current[n]):
+                yield self._holding_write(n, image[n])
+                written.append(n)
+        if written:
+            current = yield self._block_read(names, suppress=True)
+
+        # The link settings go last, Id after bAud so the unit still
+        # answers at the address it was written to.
+        last = [ 'ModL', 'bAud', 'Id' ]
+        changed = [ n for n in names if n not in written and n not in scale_deps + [ 'corf' ] and
+                    self._differs(n, image[n], current[n]) ]
+        for addr, block in plan_reads([ n for n in changed if n not in last ], self.max_block):
+            words = []
+            for n in block:
+                words += [ to_word(codecs[n].encode(image[n]), current[n][1]), 0 ]
+            yield self.bus.write(addr, words, self.unit_id)
+            written += block
+        for n in last:
+            if n in changed:
+                try:
+                    yield self._holding_write(n, image[n])
+                except TimeoutError:
+                    # The new baud rate took effect straight away, the
+                    # rest has to wait for the port to follow.
+                    if 'bAud' in written:
+                        break
+                    raise
+                written.append(n)
+                if n == 'Id':
+                    self.unit_id = int(image[n])
+        if written and not comm:
+            yield self._block_read(written)
+        twisted.internet.defer.returnValue(written)
 
     @twisted.internet.defer.inlineCallbacks
-    def flags(self):
-        us = twisted.internet.defer.Deferred()
-        self.queue.append(us)
+    def _raw(self, reg, value):
         try:
-            if len(self.queue) < 2:
-                d = twisted.internet.defer.Deferred()
-                twisted.internet.reactor.callLater(0, d.callback, None)
-                yield d
-            else:
-                yield self.queue[-2]
-            response = yield self._flags()
-        finally:
-            self.queue.pop(0)
-            us.callback(None)
+            yield self._holding_write(reg, value)
+        except:
+            pass
+        response = yield self._holding_read(reg)
         twisted.internet.defer.returnValue(response)
 
+    # Reads are answered from the value cache unless fresh or suppress is
+    # set, see values. Reads identical to one queued or on the bus share its
+    # result.
+
+    def flags(self, priority=READ, fresh=False):
+        cached = None if fresh else self._cached('flags')
+        if cached is not None:
+            val, mult, stale = cached
+            if stale:
+                self._revalidate([ 'flags' ], lambda names: self.flags(priority, True))
+            return twisted.internet.defer.succeed(val)
+        return self.bus.share(self.unit_id, priority, ('flags',), self._flags)
+
     @twisted.internet.defer.inlineCallbacks
     def flag(self, name):
         d = self.flags()
         ret, _ = yield d
         twisted.internet.defer.returnValue(ret[name])
 
-    @twisted.internet.defer.inlineCallbacks
-    def holding_read(self, reg, suppress=False):
-        us = twisted.internet.defer.Deferred()
-        self.queue.append(us)
-        try:
-            if len(self.queue) < 2:
-                d = twisted.internet.defer.Deferred()
-                twisted.internet.reactor.callLater(0, d.callback, None)
-                yield d
-            else:
-                yield self.queue[-2]
-            response = yield self._holding_read(reg, suppress)
-        finally:
-            self.queue.pop(0)
-            us.callback(None)
-        twisted.internet.defer.returnValue(response)
+    def holding_read(self, reg, suppress=False, priority=READ, fresh=False):
+        cached = None if fresh or suppress else self._cached(reg)
+        if cached is not None:
+            val, mult, stale = cached
+            if stale:
+                self._revalidate([ reg ], lambda names: self.holding_read(reg, suppress, priority, True))
+            return twisted.internet.defer.succeed((val, mult))
+        return self.bus.share(self.unit_id, priority, ('read', reg, suppress),
+                              self._holding_read, reg, suppress)
 
-    @twisted.internet.defer.inlineCallbacks
-    def coil(self, cmd, ret=None):
-        us = twisted.internet.defer.Deferred()
-        self.queue.append(us)
-        response = None
-        try:
-            if len(self.queue) < 2:
-                d = twisted.internet.defer.Deferred()
-                twisted.internet.reactor.callLater(0, d.callback, None)
-                yield d
-            else:
-                yield self.queue[-2]
-            yield self._coil(cmd)
-            response = ret
-        finally:
-            self.queue.pop(0)
-            us.callback(None)
-        twisted.internet.defer.returnValue(response)
+    def block_read(self, names, suppress=False, priority=BULK, fresh=False):
+        ret = {}
+        if not fresh and not suppress:
+            stale = []
+            for n in names:
+                cached = self._cached(n)
+                if cached is not None:
+                    ret[n] = cached[:2]
+                    if cached[2]:
+                        stale.append(n)
+            self._revalidate(stale, self.block_read, suppress, priority, True)
+            names = [ n for n in names if n not in ret ]
+            if not names:
+                return twisted.internet.defer.succeed(ret)
+        key = ('block', tuple(sorted(set(names))), suppress)
+        d = self.bus.share(self.unit_id, priority, key, self._block_read, names, suppress)
+        if ret:
+            d.addCallback(lambda values: dict(ret.items() + values.items()))
+        return d
 
-    @twisted.internet.defer.inlineCallbacks
-    def raw(self, reg, value):
-        us = twisted.internet.defer.Deferred()
-        self.queue.append(us)
-        error = False
-        try:
-            if len(self.queue) < 2:
-                d = twisted.internet.defer.Deferred()
-                twisted.internet.reactor.callLater(0, d.callback, None)
-                yield d
-            else:
-                yield self.queue[-2]
-            try:
-                yield self._holding_write(reg, value)
-            except:
-                pass
-            response = yield self._holding_read(reg)
-        finally:
-            self.queue.pop(0)
-            us.callback(None)
-        twisted.internet.defer.returnValue(response)
+    def coil(self, cmd, ret=None, priority=WRITE):
+        d = self.bus.submit(self.unit_id, priority, self._coil, cmd)
+        d.addCallback(lambda x: ret)
+        return d
+
+    def raw(self, reg, value, priority=WRITE):
+        """Write reg and return the value read back. Writes to a register
+        that is still waiting in the queue are merged, only the last value
+        is sent."""
+        return self.bus.coalesce(self.unit_id, priority, ('raw', reg), self._raw, reg, value)
+
+    def write_program(self, steps, mode='S-SV', priority=WRITE):
+        """steps is a list of (PID group, run mode, SV) tuples using the same
+        values as the C-xx, t-xx and Sv-xx registers, e.g. (0, ('Run', 30), 150)."""
+        return self.bus.submit(self.unit_id, priority, self._write_program, steps, mode)
+
+    def snapshot(self, priority=BULK):
+        return self.bus.submit(self.unit_id, priority, self._snapshot)
+
+    def restore(self, image, comm=False, priority=BULK):
+        """Write the registers in image that differ from the device and
+        return their names. Id and bAud are only restored if comm is set,
+        this handle then follows the unit to its new Id."""
+        return self.bus.submit(self.unit_id, priority, self._restore, image, comm)
+
+    def holding_write(self, reg, value, priority=WRITE):
+        return self.bus.coalesce(self.unit_id, priority, ('write', reg), self._holding_write, reg, value)
+
+    def process_queue(self):
+        return self.bus.process_queue(self.unit_id)
+
+    def subscribe(self, reg, interval, callback):
+        """Call callback(reg, val, mult) with a fresh value of reg, a
+        register name or 'flags', about every interval seconds. Registers
+        due at about the same time are fetched together with one
+        block_read, and each read serves every subscriber that is due.
+        Returns a handle for unsubscribe."""
+        sub = Subscription(reg, interval, callback)
+        self.subs.setdefault(reg, []).append(sub)
+        # A new view is watching, so the next read is shown even if
+        # unchanged.
+        self.values.pop(reg, None)
+        self._schedule()
+        return sub
+
+    def unsubscribe(self, sub):
+        subs = self.subs.get(sub.reg, [])
+        if sub in subs:
+            subs.remove(sub)
+            if not subs:
+                del self.subs[sub.reg]
+        self._schedule()
+
+    def _schedule(self):
+        if self.poll_call and self.poll_call.active():
+            self.poll_call.cancel()
+        self.poll_call = None
+        # A running poll reschedules when it finishes.
+        if self.polling or not self.subs:
+            return
+        due = min(sub.due for subs in self.subs.itervalues() for sub in subs)
+        delay = max(due - twisted.internet.reactor.seconds(), 0)
+        self.poll_call = twisted.internet.reactor.callLater(delay, self._poll)
 
     @twisted.internet.defer.inlineCallbacks
-    def holding_write(self, reg, value):
-        us = twisted.internet.defer.Deferred()
-        self.queue.append(us)
-        error = False
+    def _poll(self):
+        self.poll_call = None
+        self.polling = True
+        now = twisted.internet.reactor.seconds()
+        # Anyone due within a quarter of their interval goes along too.
+        due = [ sub for subs in self.subs.itervalues() for sub in subs
+                if sub.due - sub.interval / 4.0 <= now ]
+        for sub in due:
+            sub.due = now + sub.interval
+        regs = set(sub.reg for sub in due)
         try:
-            if len(self.queue) < 2:
-                d = twisted.internet.defer.Deferred()
-                twisted.internet.reactor.callLater(0, d.callback, None)
-                yield d
-            else:
-                yield self.queue[-2]
-            yield self._holding_write(reg, value)
+            values = {}
+            names = [ n for n in regs if n != 'flags' ]
+            if names:
+                values = yield self.block_read(names, priority=POLL, fresh=True)
+            if 'flags' in regs:
+                values['flags'] = (yield self.flags(priority=POLL, fresh=True)), 1.0
+            for sub in due:
+                if sub in self.subs.get(sub.reg, []):
+                    val, mult = values[sub.reg]
+                    try:
+                        sub.callback(sub.reg, val, mult)
+                    except Exception, e:
+                        print 'subscriber error', sub.reg, e
+        except Exception, e:
+            pass
         finally:
-            self.queue.pop(0)
-            us.callback(None)
-
-    @twisted.internet.defer.deferredGenerator
-    def process_queue(self):
-        yield self.queue[-1]
+            self.polling = False
+            self._schedule()
 
 class SerialModbusClient(twisted.internet.serialport.SerialPort):
     def __init__(self, *args, **kwargs):
-        self.protocol = Set64rs()
+        frame_gap = kwargs.pop('frame_gap', None)
+        self.protocol = Bus()
+        self.protocol.frame_gap = frame_gap
         self.decoder = pymodbus.factory.ClientDecoder()
         twisted.internet.serialport.SerialPort.__init__(self, self.protocol, *args, **kwargs)
+        self.protocol.baudrate = self._serial.baudrate
         self.flushInput()
+
+    def setBaudRate(self, baudrate):
+        twisted.internet.serialport.SerialPort.setBaudRate(self, baudrate)
+        self.protocol.baudrate = baudrate
+
+    def unit(self, unit_id=5):
+        return self.protocol.unit(unit_id)
+
+class GatewayClient(object):
+    """Connects to gateway.py over TCP, so any number of programs can
+    share the serial port it holds. Requests are queued until the
+    connection is up, and it reconnects if the gateway goes away."""
+
+    def __init__(self, host, port, reactor):
+        self.protocol = GatewayBus()
+        reactor.connectTCP(host, port, GatewayFactory(self.protocol))
+
+    def unit(self, unit_id=5):
+        return self.protocol.unit(unit_id)
+
+def connect(reactor, port='/dev/ttyUSB0', baudrate=9600, gateway=None):
+    """Opens the serial port, or the gateway at host:port if given."""
+    if gateway:
+        host, _, tcp = gateway.rpartition(':')
+        return GatewayClient(host or '127.0.0.1', int(tcp), reactor)
+    return SerialModbusClient(port, reactor, baudrate=baudrate, timeout=0.1)
@@ -16,6 +16,7 @@
 from gi.repository import Gtk
 import twisted.internet.defer
 import pld
+import widgets
 
 class Ramp_soak(Gtk.ScrolledWindow):
     def __init__(self, pid):
@@ -36,6 +37,7 @@ class Ramp_soak(Gtk.ScrolledWindow):
         renderer.set_property("adjustment", adj)
         renderer.connect('edited', self.on_group_edited)
         column = Gtk.TreeViewColumn("PID Group", renderer, text=1)
+        column.set_cell_data_func(renderer, widgets.mark_unverified_cell, (pid, 'C-%02d'))
         self.tree.append_column(column)
 
         mode_store = Gtk.ListStore(str)
@@ -49,6 +51,7 @@ class Ramp_soak(Gtk.ScrolledWindow):
         renderer.set_property("text-column", 0)
         renderer.connect('edited', self.on_mode_edited)
         column = Gtk.TreeViewColumn("Mode", renderer, text=2)
+        column.set_cell_data_func(renderer, widgets.mark_unverified_cell, (pid, 't-%02d'))
         self.tree.append_column(column)
 
         reg = pld.registers['t-01']
@@ -58,6 +61,7 @@ class Ramp_soak(Gtk.ScrolledWindow):
         renderer.set_property("adjustment", adj)
         renderer.connect('edited', self.on_time_edited)
         column = Gtk.TreeViewColumn("Runtime/Jump to", renderer, text=3)
+        column.set_cell_data_func(renderer, widgets.mark_unverified_cell, (pid, 't-%02d'))
         self.tree.append_column(column)
 
         reg = pld.registers['Sv01']
@@ -67,6 +71,7 @@ class Ramp_soak(Gtk.ScrolledWindow):
         renderer.set_property("adjustment", adj)
         renderer.connect('edited', self.on_sv_edited)
         column = Gtk.TreeViewColumn("Set Value", renderer, text=4)
+        column.set_cell_data_func(renderer, widgets.mark_unverified_cell, (pid, 'Sv%02d'))
         self.tree.append_column(column)
 
         for i in range(1,65):
@@ -74,6 +79,7 @@ class Ramp_soak(Gtk.ScrolledWindow):
 
         self.add(self.tree)
         pid.connect('changed', self.changed)
+        pid.connect('verified', lambda pid, n, ok: self.tree.queue_draw())
 
     def on_group_edited(self, widget, path, text):
         n = 'C-%02d' % (int(str(path)) + 1)
@@ -161,11 +167,9 @@ class Ramp_soak(Gtk.ScrolledWindow):
     @twisted.internet.defer.inlineCallbacks
     def _refresh(self):
         self.tree.set_cursor("0", None)
-        for row in range(1,65):
-            for col in [ "C-", "t-", "Sv" ]:
-                d = self.pid.holding_read(col + ('%02d' % row))
-                d.addErrback(lambda x: None)
-        yield self.pid.process_queue()
+        regs = [ col + ('%02d' % row) for row in range(1,65) for col in [ "C-", "t-", "Sv" ] ]
+        values = yield self.pid.block_read(regs)
+        self.pid.replay(values)
         self.tree.set_cursor("0", None)
         self.refreshed = True
 
@@ -24,6 +24,8 @@ from gi.repository import Gtk
 class PIDTab(Gtk.Table):
     def __init__(self, pid):
         Gtk.Table.__init__(self, len(self.regs), 4)
+        self.pid = pid
+        self.refreshed = False
         for row, n in enumerate(self.regs):
             reg = pld.registers[n]
 
@@ -36,18 +38,28 @@ class PIDTab(Gtk.Table):
             self.attach(label, 1, 2, row, row+1, yoptions=Gtk.AttachOptions.SHRINK)
 
             if type(reg[2]) is list:
-                combo = widgets.PIDComboBoxText(pid, n)
+                combo = widgets.PIDComboBoxText(pid, n, read=False)
                 self.attach(combo, 3, 4, row, row+1, yoptions=Gtk.AttachOptions.SHRINK)
             elif type(reg[2]) is dict:
-                combo = widgets.PIDSpinCombo(pid, n)
+                combo = widgets.PIDSpinCombo(pid, n, read=False)
                 self.attach(combo.spin, 3, 4, row, row+1, yoptions=Gtk.AttachOptions.SHRINK)
                 self.attach(combo, 2, 3, row, row+1, yoptions=Gtk.AttachOptions.SHRINK)
             else:
-                spin = widgets.PIDSpinButton(pid, n)
+                spin = widgets.PIDSpinButton(pid, n, read=False)
                 self.attach(spin, 3, 4, row, row+1, yoptions=Gtk.AttachOptions.SHRINK)
 
     def on_show(self):
-        pass
+        if not self.refreshed:
+            self.refreshed = True
+            try:
+                self.refresh()
+            except:
+                self.refreshed = False
+
+    def refresh(self):
+        d = self.pid.block_read(self.regs)
+        d.addCallback(self.pid.replay)
+        d.addErrback(lambda x: None)
 
 class Function(PIDTab):
     regs = [ 'Inty', 'PvL', 'PvH', 'dot', 'rd', 'obty', 'obL', 'obH', 'oAty',
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright (C) 2012 Russ Dill <Russ.Dill@asu.edu>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+# Append-only columnar run log.
+#
+# A file is a header followed by self contained chunks of rows:
+#
+#   'S64RUN\0\1' <u32 n> <n bytes of JSON header>
+#   'CHNK' <u32 rows> <u32 size> <size bytes of column data>
+#
+# Each column of a chunk is <u32 n> <n bytes>, the differences between
+# successive values (the first against 0) as zigzag varints. Values are
+# stored as integers, multiplied by the column's scale. The first column
+# is always the time in ms since the epoch. Slowly changing channels cost
+# one byte per row, and each chunk can be decoded on its own, so readers
+# only need to touch the chunks covering the time range they want.
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import time
+
+magic = 'S64RUN\0\1'
+chunk_magic = 'CHNK'
+chunk_header = struct.Struct('<4sII')
+length = struct.Struct('<I')
+
+# Columns recorded by the monitor and auto-tune windows, as (name, scale).
+run_columns = [('PV', 100), ('dSV', 100), ('OUT', 100),
+               ('step', 1), ('step_t', 1), ('flags', 1)]
+
+run_dir = os.path.expanduser('~/.set64rs/runs')
+
+class FormatError(Exception):
+    pass
+
+def zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+def unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+def put_varint(buf, n):
+    while n > 0x7f:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+def get_varints(buf, count):
+    ret = []
+    val = 0
+    n = 0
+    shift = 0
+    for b in buf:
+        n |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            val += unzigzag(n)
+            ret.append(val)
+            n = 0
+            shift = 0
+    if len(ret) != count:
+        raise FormatError('expected %d values, got %d' % (count, len(ret)))
+    return ret
+
+def pack_bits(flags, names):
+    """Packs a dict of booleans into an int, the first name in bit 0."""
+    if flags is None:
+        return None
+    return sum(1 << i for i, n in enumerate(names) if flags.get(n))
+
+def unpack_bits(val, names):
+    return dict((n, bool(val & (1 << i))) for i, n in enumerate(names))
+
+def read_header(m):
+    if m[:len(magic)] != magic:
+        raise FormatError('not a run log')
+    n, = length.unpack_from(m, len(magic))
+    start = len(magic) + length.size
+    header = json.loads(m[start:start+n])
+    header['columns'] = [ (str(name), scale) for name, scale in header['columns'] ]
+    return header, start + n
+
+def scan_chunks(m, offset):
+    """Returns [(offset, rows, size)] for each complete chunk from offset."""
+    chunks = []
+    end = len(m)
+    while offset + chunk_header.size <= end:
+        tag, rows, size = chunk_header.unpack_from(m, offset)
+        if tag != chunk_magic or offset + chunk_header.size + size > end:
+            break
+        chunks.append((offset, rows, size))
+        offset += chunk_header.size + size
+    return chunks
+
+class Writer(object):
+    """Appends rows to a run log. Rows are buffered and written a chunk at
+    a time, when chunk_rows rows are pending or flush_interval seconds
+    have passed. Opening an existing log appends to it, dropping any
+    chunk left incomplete by a crash."""
+
+    def __init__(self, path, columns=run_columns, chunk_rows=1024,
+                 flush_interval=60.0, **info):
+        self.columns = [('time', 1000)] + list(columns)
+        self.chunk_rows = chunk_rows
+        self.flush_interval = flush_interval
+        self.rows = []
+        self.prev = [0] * len(self.columns)
+        self.flushed = time.time()
+
+        if os.path.exists(path) and os.path.getsize(path):
+            self.f = open(path, 'r+b')
+            m = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                header, offset = read_header(m)
+                if header['columns'] != self.columns:
+                    raise FormatError('%s has columns %s' % (path, header['columns']))
+                chunks = scan_chunks(m, offset)
+            finally:
+                m.close()
+            if chunks:
+                offset, rows, size = chunks[-1]
+                offset += chunk_header.size + size
+            self.f.truncate(offset)
+            self.f.seek(offset)
+        else:
+            d = os.path.dirname(path)
+            if d and not os.path.isdir(d):
+                os.makedirs(d)
+            self.f = open(path, 'wb')
+            header = dict(info)
+            header['columns'] = self.columns
+            header['created'] = time.time()
+            data = json.dumps(header)
+            self.f.write(magic + length.pack(len(data)) + data)
+            self.f.flush()
+
+    def append(self, t, *values):
+        """Adds a row. A value of None repeats the previous row's value."""
+        if len(values) != len(self.columns) - 1:
+            raise ValueError('expected %d values' % (len(self.columns) - 1))
+        row = []
+        for (name, scale), val, prev in zip(self.columns, (t,) + values, self.prev):
+            row.append(prev if val is None else int(round(val * scale)))
+        self.prev = row
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_rows or \
+                time.time() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.flushed = time.time()
+        if not self.rows:
+            return
+        data = bytearray()
+        for col in zip(*self.rows):
+            buf = bytearray()
+            last = 0
+            for val in col:
+                put_varint(buf, zigzag(val - last))
+                last = val
+            data += length.pack(len(buf))
+            data += buf
+        self.f.write(chunk_header.pack(chunk_magic, len(self.rows), len(data)))
+        self.f.write(data)
+        self.f.flush()
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+class Reader(object):
+    """Reads a run log through mmap. Opening a log only walks the chunk
+    headers; rows are decoded a chunk at a time as they are asked for."""
+
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header, offset = read_header(self.map)
+        self.columns = self.header['columns']
+        self.chunks = scan_chunks(self.map, offset)
+        # The first time of each chunk, for seeking.
+        self.times = [ self.first_time(c) for c in self.chunks ]
+
+    def __len__(self):
+        return sum(rows for offset, rows, size in self.chunks)
+
+    def first_time(self, chunk):
+        offset, rows, size = chunk
+        start = offset + chunk_header.size + length.size
+        n = 0
+        shift = 0
+        for b in bytearray(self.map[start:start+10]):
+            n |= (b & 0x7f) << shift
+            shift += 7
+            if not b & 0x80:
+                break
+        return unzigzag(n) / 1000.0
+
+    def chunk(self, i):
+        """Returns the rows of chunk i as a list of value lists, one per
+        column."""
+        offset, rows, size = self.chunks[i]
+        offset += chunk_header.size
+        ret = []
+        for name, scale in self.columns:
+            n, = length.unpack_from(self.map, offset)
+            offset += length.size
+            vals = get_varints(bytearray(self.map[offset:offset+n]), rows)
+            offset += n
+            if scale != 1:
+                vals = [ val / float(scale) for val in vals ]
+            ret.append(vals)
+        return ret
+
+    def read(self, start=None, end=None):
+        """Yields rows, as tuples starting with the time, with start <= time
+        < end."""
+        first = 0
+        if start is not None:
+            first = max(bisect.bisect_right(self.times, start) - 1, 0)
+        for i in range(first, len(self.chunks)):
+            if end is not None and self.times[i] >= end:
+                break
+            for row in zip(*self.chunk(i)):
+                if start is not None and row[0] < start:
+                    continue
+                if end is not None and row[0] >= end:
+                    break
+                yield row
+
+    def close(self):
+        self.map.close()
+        self.f.close()
+
+def new_run(kind, unit_id, **info):
+    """Starts a new log in run_dir named for the kind of run, unit and
+    time."""
+    name = '%s-%d-%s.run' % (kind, unit_id, time.strftime('%Y%m%d-%H%M%S'))
+    return Writer(os.path.join(run_dir, name), kind=kind, unit=unit_id, **info)
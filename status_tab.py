@@ -93,8 +93,10 @@ class Status(Gtk.Table):
         for n in self.regs:
             if n == 'flags':
                 d = self.pid.flags()
+                d.addCallback(lambda val: val is not None and self.pid.replay({ 'flags': (val, 1.0) }))
             else:
                 d = self.pid.holding_read(n)
+                d.addCallback(lambda val, n=n: self.pid.replay({ n: val }))
             d.addErrback(lambda x: None)
         yield self.pid.process_queue()
 
@@ -13,6 +13,7 @@
 #  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 #  GNU General Public License for more details.
 
+import argparse
 import time
 
 import twisted.internet.gtk3reactor
@@ -23,8 +24,6 @@ import registers_tab
 import status_tab
 import pid_tab
 import ramp_soak_tab
-import autotune
-import monitor
 
 from gi.repository import Gtk
 
@@ -42,14 +41,26 @@ UI_INFO = """
 </ui>
 """
 
+# See widgets.mark_unverified.
+CSS = """
+.unverified, .unverified * {
+    color: gray;
+}
+"""
+
 class PIDWindow(Gtk.Window):
     def __init__(self, pid):
         Gtk.Window.__init__(self, title="Set64rs")
 
+        css = Gtk.CssProvider()
+        css.load_from_data(CSS)
+        Gtk.StyleContext.add_provider_for_screen(self.get_screen(), css,
+                                                 Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
+
         action_group = Gtk.ActionGroup("profile_actions")
         action_group.add_actions([
             ("FileMenu", None, "File", None, None, None),
-            ("FileQuit", Gtk.STOCK_QUIT, "_Quit", "<control>Q", None, Gtk.main_quit),
+            ("FileQuit", Gtk.STOCK_QUIT, "_Quit", "<control>Q", None, self.on_quit),
             ("ActionMenu", None, "Action", None, None, None),
             ("ActionAT", None, "Auto-tune", None, None, self.on_at),
             ("ActionMonitor", None, "Monitor", None, None, self.on_monitor)
@@ -64,33 +75,77 @@ class PIDWindow(Gtk.Window):
 
         self.pid = pid
         self.notebook = Gtk.Notebook()
-        self.notebook.append_page(registers_tab.Function(pid), Gtk.Label("Function"))
-        self.notebook.append_page(registers_tab.Work(pid), Gtk.Label("Work"))
-        self.notebook.append_page(registers_tab.Control(pid), Gtk.Label("Control"))
-        self.notebook.append_page(status_tab.Status(pid), Gtk.Label("Status"))
-        self.notebook.append_page(pid_tab.PID(pid), Gtk.Label("PID"))
-        self.notebook.append_page(ramp_soak_tab.Ramp_soak(pid), Gtk.Label("Ramp/soak"))
+        # Tabs are built the first time they are shown, page -> class.
+        self.tabs = {}
+        for tab, title in [ (registers_tab.Function, "Function"),
+                            (registers_tab.Work, "Work"),
+                            (registers_tab.Control, "Control"),
+                            (status_tab.Status, "Status"),
+                            (pid_tab.PID, "PID"),
+                            (ramp_soak_tab.Ramp_soak, "Ramp/soak") ]:
+            page = Gtk.Box()
+            self.notebook.append_page(page, Gtk.Label(title))
+            self.tabs[page] = tab
         self.notebook.connect('switch-page', self.on_select_page)
+        self.on_select_page(self.notebook, self.notebook.get_nth_page(0), 0)
         vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         vbox.pack_start(menubar, False, False, 0)
         vbox.add(self.notebook)
+        self.statusbar = Gtk.Statusbar()
+        self.status_id = self.statusbar.get_context_id('bus')
+        vbox.pack_start(self.statusbar, False, False, 0)
         self.add(vbox)
+        pid.connect('stats', self.on_stats)
+
+    def on_quit(self, *args):
+        # Through the reactor, so shutdown triggers like saving the
+        # register cache run.
+        twisted.internet.reactor.stop()
+
+    # The charts pull in matplotlib, so they are only imported when used.
 
     def on_at(self, widget):
+        import autotune
         win = autotune.ATWindow(self.pid)
         win.show_all()
 
     def on_monitor(self, widget):
+        import monitor
         win = monitor.MonitorWindow(self.pid)
         win.show_all()
 
     def on_select_page(self, notebook, page, page_num):
-        page.on_show()
+        if page in self.tabs:
+            page.pack_start(self.tabs.pop(page)(self.pid), True, True, 0)
+            page.show_all()
+        page.get_children()[0].on_show()
+
+    def on_stats(self, pid, report):
+        recent = report['recent']
+        text = '%.1f txn/s  %.0f%% bus  queue %d  %d timeouts  %d resets  %d CRC errors' % (
+            recent['tps'], recent['utilization'], report['queue_depth'],
+            report['timeouts'], report['resets'], report['crc_errors'])
+        if pid.unverified:
+            text = '%d values from last session not yet verified  ' % len(pid.unverified) + text
+        self.statusbar.pop(self.status_id)
+        self.statusbar.push(self.status_id, text)
 
 def main():
-    port = pld.SerialModbusClient("/dev/ttyUSB0", twisted.internet.reactor, timeout=0.1)
-    win = PIDWindow(port.protocol)
-    win.connect('delete-event', Gtk.main_quit)
+    parser = argparse.ArgumentParser(description='SET64rs controller GUI.')
+    parser.add_argument('-p', '--port', default='/dev/ttyUSB0')
+    parser.add_argument('-g', '--gateway', help='use gateway.py at host:port instead of the port')
+    parser.add_argument('-s', '--serve', type=int, metavar='TCP_PORT',
+                        help='share the port with other programs through a gateway on localhost')
+    args = parser.parse_args()
+
+    port = pld.connect(twisted.internet.reactor, args.port, gateway=args.gateway)
+    if args.serve:
+        import gateway
+        gateway.serve(port.protocol, args.serve)
+    pid = port.unit()
+    win = PIDWindow(pid)
+    win.connect('delete-event', win.on_quit)
+    pid.persist()
 
     win.show_all()
     twisted.internet.reactor.run()
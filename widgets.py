@@ -20,6 +20,25 @@ import pld
 
 import twisted.internet.gtk3reactor
 
+def mark_unverified(widget, pid, name):
+    """Style widget as 'unverified' while the value of name shown is
+    one saved by the last session."""
+    def verified(pid, n, ok):
+        if n == name:
+            if ok:
+                widget.get_style_context().remove_class('unverified')
+            else:
+                widget.get_style_context().add_class('unverified')
+    verified(pid, name, name not in pid.unverified)
+    pid.connect('verified', verified)
+
+def mark_unverified_cell(column, renderer, model, treeiter, data):
+    """Cell data function greying the cell like mark_unverified, data is
+    (pid, format of the register name from the row's first column)."""
+    pid, fmt = data
+    renderer.set_property('foreground', 'gray')
+    renderer.set_property('foreground-set', fmt % model[treeiter][0] in pid.unverified)
+
 class ActionCheckButton(Gtk.CheckButton):
     def __init__(self, action, read=None, label=None, use_underline=True):
         super(ActionCheckButton, self).__init__(label=label, use_underline=use_underline)
@@ -166,13 +185,14 @@ class ActionComboBoxText(Gtk.ComboBoxText):
         self.busy -= 1
 
 class PIDComboBoxText(ActionComboBoxText):
-    def __init__(self, pid, name):
-        super(PIDComboBoxText, self).__init__(lambda val: pid.raw(name, val), read=lambda name=name: pid.holding_read(name))
+    def __init__(self, pid, name, read=True):
+        super(PIDComboBoxText, self).__init__(lambda val: pid.raw(name, val), read=(lambda name=name: pid.holding_read(name)) if read else None)
         reg = pld.registers[name]
         for text in reg[2]:
             if text is not None:
                 self.append_text(text)
         pid.connect('changed', lambda pid, n, val, mult: self.set_active(self.lookup(val), user=False) if n == name else None)
+        mark_unverified(self, pid, name)
 
 class ActionSpinButton(Gtk.SpinButton):
     def __init__(self, action, read=None, adjustment=None, climb_rate=0.0, digits=0):
@@ -250,8 +270,8 @@ class ActionSpinButton(Gtk.SpinButton):
         self.busy -= 1
 
 class PIDSpinButton(ActionSpinButton):
-    def __init__(self, pid, name):
-        super(PIDSpinButton, self).__init__(lambda val: pid.raw(name, val), read=lambda name=name: pid.holding_read(name))
+    def __init__(self, pid, name, read=True):
+        super(PIDSpinButton, self).__init__(lambda val: pid.raw(name, val), read=(lambda name=name: pid.holding_read(name)) if read else None)
         reg = pld.registers[name]
         adjustment = Gtk.Adjustment()
         adjustment.set_lower(reg[2][0])
@@ -259,9 +279,10 @@ class PIDSpinButton(ActionSpinButton):
         adjustment.set_step_increment(1)
         self.set_adjustment(adjustment)
         pid.connect('changed', lambda pid, n, val, mult: self.set_value(val, mult=mult, user=False) if n == name else None)
+        mark_unverified(self, pid, name)
 
 class PIDSpinCombo(Gtk.ComboBoxText):
-    def __init__(self, pid, name):
+    def __init__(self, pid, name, read=True):
         super(PIDSpinCombo, self).__init__()
         self.reg = pld.registers[name]
         self.spin = Gtk.SpinButton()
@@ -276,8 +297,10 @@ class PIDSpinCombo(Gtk.ComboBoxText):
         self.adjustment_cached = self.spin.get_adjustment()
         self.spin_cached = self.spin.get_value()
         self.action = lambda val: pid.raw(name, val)
-        self.read = lambda name=name: pid.holding_read(name)
+        self.read = (lambda name=name: pid.holding_read(name)) if read else None
         pid.connect('changed', lambda pid, n, val, mult: self.pid_changed(val, mult) if n == name else None)
+        mark_unverified(self, pid, name)
+        mark_unverified(self.spin, pid, name)
         if self.read is not None:
             self.connect('show', self.on_show)
             self.refreshed = False